@@ -0,0 +1,77 @@
+#!/usr/bin/env python2
+
+# Time fair queue insert positions at growing queue sizes. The legacy
+# round-robin scan from sboxify_playlist.add_track is timed alongside for
+# comparison; it is skipped at sizes where it gets too slow to wait for.
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fairqueue import fair_queue
+
+parser = argparse.ArgumentParser(description='fair queue benchmark')
+parser.add_argument('--sizes', default="100,1000,10000,100000", help='comma separated queue sizes')
+parser.add_argument('--users', type=int, default=50, help="number of distinct users")
+parser.add_argument('--ops', type=int, default=1000, help="timed inserts per size")
+parser.add_argument('--legacy_max', type=int, default=10000, help="largest size to run the legacy scan at")
+args = parser.parse_args()
+
+def legacy_offset(users, user_id):
+    found = []
+    offset = 0
+
+    while not found:
+        for idx,user in enumerate(users[offset:]):
+            if user in found:
+                break
+
+            found.append(user)
+
+        offset += idx
+
+        if user_id not in found:
+            break
+
+        found = []
+
+    return offset
+
+def bench(size):
+    users = ["user{}".format(i) for i in range(args.users)]
+    queued = [random.choice(users) for i in range(size)]
+    queue = fair_queue(queued)
+    picks = [random.choice(users) for i in range(args.ops)]
+
+    start = time.time()
+
+    for user in picks:
+        queue.position(user)
+        queue.add(user)
+        queue.remove(user)
+
+    fair = (time.time() - start) / args.ops * 1e6
+
+    if size > args.legacy_max:
+        return fair,None
+
+    start = time.time()
+
+    for user in picks[:100]:
+        legacy_offset(queued, user)
+
+    legacy = (time.time() - start) / min(100, args.ops) * 1e6
+
+    return fair,legacy
+
+if __name__ == "__main__":
+    print("{:>10} {:>14} {:>14}".format("size", "fair (us/op)", "legacy (us/op)"))
+
+    for size in [int(s) for s in args.sizes.split(",")]:
+        fair,legacy = bench(size)
+        legacy = "-" if legacy is None else "{:.1f}".format(legacy)
+        print("{:>10} {:>14.1f} {:>14}".format(size, fair, legacy))
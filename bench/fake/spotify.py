@@ -0,0 +1,427 @@
+#!/usr/bin/env python2
+
+# Stand-in for pyspotify, good enough to run sboxify without an account
+# or an audio device. Entities are made up from their URI and become
+# loaded after a simulated latency; configure() sets the latency per
+# entity type, in seconds.
+
+from threading import Thread as thread
+from threading import Event as event
+from threading import RLock as lock
+import hashlib
+import random
+import heapq
+import time
+
+latencies = {
+             "track": (.005, .05),
+             "album": (.005, .05),
+             "artist": (.005, .05),
+             "image": (.01, .1),
+             "playlist": (.01, .1),
+             "browse": (.05, .3),
+             "search": (.05, .3),
+            }
+
+def configure(**kwargs):
+    latencies.update(kwargs)
+
+def latency(kind):
+    low,high = latencies.get(kind, (0, 0))
+
+    return random.uniform(low, high)
+
+def number(uri):
+    # stable across runs and python versions
+    return int(hashlib.md5(uri.encode("utf-8")).hexdigest()[:8], 16)
+
+class Timeout(Exception):
+    pass
+
+class Error(Exception):
+    pass
+
+class SessionEvent(object):
+    CONNECTION_STATE_UPDATED = "connection_state_updated"
+    METADATA_UPDATED = "metadata_updated"
+    END_OF_TRACK = "end_of_track"
+    MUSIC_DELIVERY = "music_delivery"
+    NOTIFY_MAIN_THREAD = "notify_main_thread"
+
+class PlaylistEvent(object):
+    TRACKS_ADDED = "tracks_added"
+    TRACKS_REMOVED = "tracks_removed"
+    TRACKS_MOVED = "tracks_moved"
+
+class ConnectionState(object):
+    LOGGED_OUT = 0
+    LOGGED_IN = 1
+
+class SearchType(object):
+    STANDARD = 0
+    SUGGEST = 1
+
+class ImageSize(object):
+    NORMAL = 0
+    SMALL = 1
+    LARGE = 2
+
+class PlayerState(object):
+    UNLOADED = "unloaded"
+    LOADED = "loaded"
+    PLAYING = "playing"
+    PAUSED = "paused"
+
+class player(object):
+    PlayerState = PlayerState
+
+class emitter(object):
+    def on(self, event, listener, *args):
+        self.__dict__.setdefault("listeners", {}).setdefault(event, []).append((listener, args))
+
+    def emit(self, event, *args):
+        for listener,extra in list(self.__dict__.get("listeners", {}).get(event, [])):
+            listener(*(args + extra))
+
+class Link(object):
+    def __init__(self, uri):
+        self.uri = uri
+        self.url = "https://open.spotify.com/" + "/".join(uri.split(":")[1:])
+
+class entity(object):
+    kind = None
+
+    def __init__(self, session, uri):
+        self._session = session
+        self.link = Link(uri)
+        self.ready = session.schedule(latency(self.kind))
+
+    @property
+    def is_loaded(self):
+        return time.time() >= self.ready
+
+    def load(self, timeout=None):
+        remaining = self.ready - time.time()
+
+        if timeout is not None and remaining > timeout:
+            time.sleep(timeout)
+            raise Timeout(timeout)
+
+        if remaining > 0:
+            time.sleep(remaining)
+
+        return self
+
+class Image(entity):
+    kind = "image"
+
+    @property
+    def data(self):
+        return b"\xff\xd8\xff\xe0" + self.link.uri.encode("utf-8") + b"\xff\xd9"
+
+    format = "jpeg"
+
+class Artist(entity):
+    kind = "artist"
+
+    @property
+    def name(self):
+        return u"Artist {}".format(number(self.link.uri) % 10000)
+
+    def portrait(self, image_size=None):
+        return self._session.get_image("spotify:image:{:040x}".format(number(self.link.uri)))
+
+    def browse(self):
+        return ArtistBrowser(self._session, self)
+
+class Album(entity):
+    kind = "album"
+
+    @property
+    def name(self):
+        return u"Album {}".format(number(self.link.uri) % 10000)
+
+    @property
+    def artist(self):
+        return self._session.get_artist("spotify:artist:{}".format(number(self.link.uri) % 500))
+
+    year = 2015
+    type = 0
+
+    def cover(self, image_size=None):
+        return self._session.get_image("spotify:image:{:040x}".format(number(self.link.uri) + 1))
+
+    def browse(self):
+        return AlbumBrowser(self._session, self)
+
+class Track(entity):
+    kind = "track"
+
+    def __new__(cls, session, uri):
+        return session.get_track(uri)
+
+    def __init__(self, session, uri):
+        pass
+
+    @property
+    def name(self):
+        return u"Track {}".format(number(self.link.uri) % 100000)
+
+    @property
+    def album(self):
+        return self._session.get_album("spotify:album:{}".format(number(self.link.uri) % 2000))
+
+    @property
+    def artists(self):
+        return [self._session.get_artist("spotify:artist:{}".format(number(self.link.uri) % 500))]
+
+    @property
+    def duration(self):
+        return 120000 + number(self.link.uri) % 180000
+
+    @property
+    def popularity(self):
+        return number(self.link.uri) % 100
+
+def make_track(session, uri):
+    track = object.__new__(Track)
+    entity.__init__(track, session, uri)
+
+    return track
+
+class browser(entity):
+    kind = "browse"
+
+    def __init__(self, session, subject):
+        entity.__init__(self, session, subject.link.uri)
+        self.subject = subject
+
+    def make_tracks(self, count):
+        seed = number(self.link.uri)
+
+        return [self._session.get_track("spotify:track:{}".format(seed + i)) for i in range(count)]
+
+class AlbumBrowser(browser):
+    @property
+    def tracks(self):
+        return self.make_tracks(12)
+
+class ArtistBrowser(browser):
+    @property
+    def tracks(self):
+        return self.make_tracks(10)
+
+    @property
+    def albums(self):
+        seed = number(self.link.uri)
+
+        return [self._session.get_album("spotify:album:{}".format(seed + i)) for i in range(8)]
+
+class Search(browser):
+    kind = "search"
+
+    def __init__(self, session, query):
+        entity.__init__(self, session, "spotify:search:" + query)
+        self.query = query
+
+    @property
+    def tracks(self):
+        return self.make_tracks(20)
+
+    @property
+    def albums(self):
+        seed = number(self.link.uri)
+
+        return [self._session.get_album("spotify:album:{}".format(seed + i)) for i in range(5)]
+
+    @property
+    def artists(self):
+        seed = number(self.link.uri)
+
+        return [self._session.get_artist("spotify:artist:{}".format(seed + i)) for i in range(5)]
+
+class Playlist(entity, emitter):
+    kind = "playlist"
+
+    def __init__(self, session, uri, name="sbox"):
+        entity.__init__(self, session, uri)
+        self.name = name
+        self._tracks = []
+        self.lock = lock()
+
+    @property
+    def tracks(self):
+        with self.lock:
+            return list(self._tracks)
+
+    def add_tracks(self, tracks, index=None):
+        if not isinstance(tracks, list):
+            tracks = [tracks]
+
+        with self.lock:
+            if index is None:
+                index = len(self._tracks)
+
+            self._tracks[index:index] = tracks
+
+        self.emit(PlaylistEvent.TRACKS_ADDED, self, tracks, index)
+
+    def remove_tracks(self, indexes):
+        if not isinstance(indexes, list):
+            indexes = [indexes]
+
+        with self.lock:
+            for index in sorted(indexes, reverse=True):
+                del self._tracks[index]
+
+        self.emit(PlaylistEvent.TRACKS_REMOVED, self, indexes)
+
+    def reorder_tracks(self, indexes, new_index):
+        with self.lock:
+            moved = [self._tracks[index] for index in indexes]
+
+            for index in sorted(indexes, reverse=True):
+                del self._tracks[index]
+
+            new_index -= len([index for index in indexes if index < new_index])
+            self._tracks[new_index:new_index] = moved
+
+        self.emit(PlaylistEvent.TRACKS_MOVED, self, indexes, new_index)
+
+class PlaylistContainer(object):
+    def __init__(self, session):
+        self.session = session
+
+    def add_new_playlist(self, name):
+        uri = "spotify:user:sbox:playlist:{}".format(random.randint(0, 1 << 30))
+
+        return self.session.get_playlist(uri, name)
+
+class Player(object):
+    def __init__(self, session):
+        self.session = session
+        self.state = PlayerState.UNLOADED
+        self.track = None
+
+    def load(self, track):
+        self.track = track
+        self.state = PlayerState.LOADED
+
+    def prefetch(self, track):
+        pass
+
+    def play(self, play=True):
+        self.state = PlayerState.PLAYING if play else PlayerState.PAUSED
+
+    def pause(self):
+        self.play(False)
+
+    def unload(self):
+        self.state = PlayerState.UNLOADED
+        self.track = None
+
+class Connection(object):
+    state = ConnectionState.LOGGED_OUT
+
+class Session(emitter):
+    def __init__(self, config=None):
+        self.lock = lock()
+        self.pending = []
+        self.objects = {}
+        self.connection = Connection()
+        self.player = Player(self)
+        self.playlist_container = PlaylistContainer(self)
+
+    def schedule(self, delay):
+        ready = time.time() + delay
+
+        with self.lock:
+            # like libspotify, ask for process_events() when the next
+            # deadline moves closer
+            notify = not self.pending or ready < self.pending[0]
+            heapq.heappush(self.pending, ready)
+
+        if notify:
+            self.emit(SessionEvent.NOTIFY_MAIN_THREAD, self)
+
+        return ready
+
+    def process_events(self):
+        now = time.time()
+        updated = False
+
+        with self.lock:
+            while self.pending and self.pending[0] <= now:
+                heapq.heappop(self.pending)
+                updated = True
+
+            timeout = (self.pending[0] - now) if self.pending else 1
+
+        if updated:
+            self.emit(SessionEvent.METADATA_UPDATED, self)
+
+        return int(timeout * 1000)
+
+    def get(self, cls, uri, *args):
+        with self.lock:
+            obj = self.objects.get(uri)
+
+        if obj is None:
+            obj = cls(self, uri, *args) if cls is not Track else make_track(self, uri)
+
+            with self.lock:
+                obj = self.objects.setdefault(uri, obj)
+
+        return obj
+
+    def get_track(self, uri):
+        if not uri.startswith("spotify:track:"):
+            raise ValueError("not a track uri: {}".format(uri))
+
+        return self.get(Track, uri)
+
+    def get_album(self, uri):
+        return self.get(Album, uri)
+
+    def get_artist(self, uri):
+        return self.get(Artist, uri)
+
+    def get_image(self, uri):
+        return self.get(Image, uri)
+
+    def get_playlist(self, uri, name="sbox"):
+        return self.get(Playlist, uri, name)
+
+    def search(self, query, search_type=SearchType.STANDARD, **kwargs):
+        return Search(self, query)
+
+    def login(self, username, password, **kwargs):
+        self.connection.state = ConnectionState.LOGGED_IN
+        timer = thread(None, self.emit, "fake login", (SessionEvent.CONNECTION_STATE_UPDATED, self))
+        timer.daemon = True
+        timer.start()
+
+    def logout(self):
+        self.connection.state = ConnectionState.LOGGED_OUT
+
+class EventLoop(thread):
+    def __init__(self, session):
+        thread.__init__(self, None, self.run, "fake event loop")
+        self.daemon = True
+        self.session = session
+        self.stopping = event()
+
+    def run(self):
+        while not self.stopping.is_set():
+            timeout = self.session.process_events()
+            self.stopping.wait(min(timeout, 10) / 1000.0)
+
+    def stop(self):
+        self.stopping.set()
+
+class AlsaSink(object):
+    def __init__(self, session, device="default"):
+        self.session = session
+
+class PortAudioSink(AlsaSink):
+    pass
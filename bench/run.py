@@ -0,0 +1,177 @@
+#!/usr/bin/env python2
+
+# Offline load test: runs sboxify against the fake spotify module in
+# bench/fake and drives the flask routes and playlist operations at
+# growing playlist sizes and client counts.
+
+import os
+import sys
+import time
+import random
+import shutil
+import logging
+import argparse
+import tempfile
+from threading import Thread as thread
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+sys.path.insert(0, os.path.join(here, "fake"))
+
+import spotify
+from sboxify import sboxify
+from service import service
+
+parser = argparse.ArgumentParser(description='sbox offline benchmark')
+parser.add_argument('--sizes', default="100,1000,5000", help='comma separated playlist sizes')
+parser.add_argument('--clients', default="1,8,32", help="comma separated client counts")
+parser.add_argument('--requests', type=int, default=20, help="requests per client per route")
+parser.add_argument('--users', type=int, default=20, help="distinct user ids")
+parser.add_argument('--latency', type=float, default=1.0, help="scale simulated libspotify latencies")
+parser.add_argument('--verbose', action='store_true', help="log from sbox itself")
+args = parser.parse_args()
+
+class bench_config(object):
+    def __init__(self, path):
+        self.__dict__["values"] = {
+            "spotify_user": "bench",
+            "spotify_pass": "bench",
+            "spotify_playlist": {"name": "sbox", "uri": None},
+            "spotify_index": 0,
+            "spotify_sink": "null",
+            "user_admins": ["admin"],
+            "user_list": os.path.join(path, "user_list.yaml"),
+            "playlist_snapshot": os.path.join(path, "playlist.json"),
+            "history_file": os.path.join(path, "history.jsonl"),
+            "image_cache_dir": os.path.join(path, "images"),
+            "http_host": "127.0.0.1",
+            "http_port": 0,
+            # measure capacity, not the limits
+            "rate_limits": {},
+            "spotify_max_inflight": 0,
+        }
+
+    def __getattr__(self, key):
+        try:
+            return self.values[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self.values[key] = value
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+def percentile(values, p):
+    values = sorted(values)
+
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+def run_clients(clients, func):
+    latencies = []
+    errors = []
+
+    def client(n):
+        for i in range(args.requests):
+            start = time.time()
+
+            try:
+                func(n, i)
+            except Exception as e:
+                errors.append(e)
+
+            latencies.append(time.time() - start)
+
+    threads = [thread(None, client, "client {}".format(n), (n,)) for n in range(clients)]
+    start = time.time()
+
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    elapsed = time.time() - start
+
+    return len(latencies) / elapsed, latencies, errors
+
+def user(n):
+    return "user{}".format(n % args.users)
+
+def track(n):
+    return "spotify:track:{}".format(n)
+
+def check(response):
+    if response.status_code >= 400:
+        raise Exception("{} {}".format(response.status_code, response.data[:80]))
+
+    return response
+
+def routes(app, size):
+    client = app.test_client()
+    # versions carry the process epoch; replay changes from the first one
+    epoch = check(client.get("/playlist?limit=1")).get_json()["version"].rpartition("-")[0]
+    since = "{}-0".format(epoch)
+
+    return [
+        ("GET /playlist", lambda n, i: check(client.get("/playlist?limit=50&id={}".format(user(n))))),
+        ("GET /playlist since", lambda n, i: check(client.get("/playlist?since={}".format(since)))),
+        ("GET /search", lambda n, i: check(client.get("/search?q=query{}".format(random.randint(0, 50))))),
+        ("GET /artist", lambda n, i: check(client.get("/artist?key=spotify:artist:{}".format(random.randint(0, 100))))),
+        ("POST /playlist/add", lambda n, i: check(client.post("/playlist/add", json={"key": track(size + n * 1000 + i), "id": user(n)}))),
+    ]
+
+def playlist_ops(s):
+    return [
+        ("playlist.get_user_tracks", lambda n, i: s.playlist.get_user_tracks(user(n))),
+        ("playlist.add_tracks", lambda n, i: s.playlist.add_tracks([track(10 ** 6 + n * 1000 + i)], user(n))),
+        ("playlist.remove_tracks", lambda n, i: s.playlist.remove_tracks([track(10 ** 6 + n * 1000 + i)], user(n))),
+    ]
+
+def fill(s, size):
+    have = len(s.playlist.playlist.tracks)
+    keys = [track(n) for n in range(have, size)]
+
+    for start in range(0, len(keys), 500):
+        s.playlist.add_tracks(keys[start:start + 500], user(start))
+
+def main():
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    for kind,(low,high) in list(spotify.latencies.items()):
+        spotify.latencies[kind] = (low * args.latency, high * args.latency)
+
+    path = tempfile.mkdtemp(prefix="sbox-bench-")
+    config = bench_config(path)
+    s = sboxify(config)
+    srv = service(config, s)
+    s.start()
+
+    while not s.is_logged_in():
+        time.sleep(.01)
+
+    print("{:<26} {:>6} {:>7} {:>9} {:>9} {:>9} {:>6}".format(
+          "operation", "size", "clients", "req/s", "p50 ms", "p99 ms", "errors"))
+
+    try:
+        for size in [int(n) for n in args.sizes.split(",")]:
+            fill(s, size)
+
+            for clients in [int(n) for n in args.clients.split(",")]:
+                for name,func in routes(srv.app, size) + playlist_ops(s):
+                    rate,latencies,errors = run_clients(clients, func)
+                    print("{:<26} {:>6} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>6}".format(
+                          name, size, clients, rate,
+                          percentile(latencies, .5) * 1000,
+                          percentile(latencies, .99) * 1000,
+                          len(errors)))
+
+                    if errors and args.verbose:
+                        print("  first error: {}".format(errors[0]))
+    finally:
+        s.stop()
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    main()
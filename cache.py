@@ -0,0 +1,190 @@
+#!/usr/bin/env python2
+
+from threading import RLock as lock
+from collections import OrderedDict
+import tempfile
+import logging
+import time
+import os
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+class lru_cache(object):
+    def __init__(self, name, size=1000, ttl=3600):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.lock = lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            return entry is not None and entry[0] >= time.time()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires,value = entry
+
+            if expires < time.time():
+                self.misses += 1
+                return default
+
+            self.entries[key] = entry
+            self.hits += 1
+
+            return value
+
+    def expires(self, key):
+        # doubles as a stamp of when the live entry was stored
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] < time.time():
+                return None
+
+            return entry[0]
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return value
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def flush(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+        log.debug("flushed {} cache".format(self.name))
+
+    def stats(self):
+        with self.lock:
+            return {
+                    "name": self.name,
+                    "size": len(self.entries),
+                    "max_size": self.size,
+                    "ttl": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "generation": self.generation,
+                   }
+
+class disk_cache(object):
+    def __init__(self, path, size=100 * 1024 * 1024):
+        self.path = path
+        self.size = size
+        self.lock = lock()
+        self.entries = OrderedDict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # oldest first, so eviction picks up where the last run left off
+        names = [(os.path.getmtime(os.path.join(path, name)), name) for name in os.listdir(path)]
+
+        for mtime,name in sorted(names):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(path, name))
+                continue
+
+            size = os.path.getsize(os.path.join(path, name))
+            self.entries[name] = size
+            self.used += size
+
+        self.evict()
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.entries:
+                self.misses += 1
+                return None
+
+            self.entries[name] = self.entries.pop(name)
+            self.hits += 1
+
+        try:
+            with open(os.path.join(self.path, name), 'rb') as f:
+                return f.read()
+        except IOError:
+            self.remove(name)
+            return None
+
+    def put(self, name, data):
+        # each writer gets its own temp file, so racing puts of one name
+        # just replace each other
+        fd,tmp = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            os.rename(tmp, os.path.join(self.path, name))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+        with self.lock:
+            self.used -= self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            self.used += len(data)
+            self.evict()
+
+        return data
+
+    def remove(self, name):
+        with self.lock:
+            self.used -= self.entries.pop(name, 0)
+
+    def evict(self):
+        with self.lock:
+            while self.used > self.size and self.entries:
+                name,size = self.entries.popitem(last=False)
+                self.used -= size
+
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                    "name": "image",
+                    "size": len(self.entries),
+                    "bytes": self.used,
+                    "max_bytes": self.size,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                   }
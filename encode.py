@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+
+import zlib
+
+try:
+    import ujson
+
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"))
+
+encodings = ("gzip", "deflate")
+
+def to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+
+    return s.encode("utf-8")
+
+# Props that never change once built (tracks, albums, artists, browse
+# results) are kept as fragments, so their json is encoded once and
+# spliced into every response that lists them.
+class fragment(dict):
+    __slots__ = ("encoded", "compressed")
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.encoded = None
+        self.compressed = {}
+
+    def json(self):
+        if self.encoded is None:
+            out = []
+            write_dict(self, out.append)
+            self.encoded = b"".join(out)
+
+        return self.encoded
+
+    def compress(self, encoding, level):
+        out = self.compressed.get(encoding)
+
+        if out is None:
+            out = self.compressed[encoding] = compress(self.json(), encoding, level)
+
+        return out
+
+def has_fragments(obj):
+    if isinstance(obj, fragment):
+        return True
+
+    if isinstance(obj, dict):
+        return any(has_fragments(value) for value in obj.values())
+
+    if isinstance(obj, (list, tuple)):
+        return any(has_fragments(value) for value in obj)
+
+    return False
+
+def encode_plain(obj):
+    out = []
+    write(obj, out.append)
+
+    return b"".join(out)
+
+def write_dict(obj, emit):
+    sep = b"{"
+
+    for key,value in obj.items():
+        emit(sep + to_bytes(dumps(key)) + b":")
+        write(value, emit)
+        sep = b","
+
+    emit(b"}" if sep == b"," else b"{}")
+
+def write(obj, emit):
+    if isinstance(obj, fragment):
+        emit(obj.json())
+    elif isinstance(obj, dict):
+        write_dict(obj, emit)
+    elif isinstance(obj, (list, tuple)) and not any(isinstance(value, dict) for value in obj):
+        emit(to_bytes(dumps(obj)))
+    elif isinstance(obj, (list, tuple)):
+        sep = b"["
+
+        for value in obj:
+            emit(sep)
+            write(value, emit)
+            sep = b","
+
+        emit(b"]" if sep == b"," else b"[]")
+    else:
+        emit(to_bytes(dumps(obj)))
+
+def encode(obj):
+    if isinstance(obj, fragment):
+        return obj.json()
+
+    if not has_fragments(obj):
+        return to_bytes(dumps(obj))
+
+    return encode_plain(obj)
+
+def compress(data, encoding, level=6):
+    if encoding == "gzip":
+        c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+
+    if encoding == "deflate":
+        return zlib.compress(data, level)
+
+    return data
+
+def encode_response(obj, encoding=None, level=6, min_size=1024):
+    # returns the body and the content encoding actually applied
+    body = encode(obj)
+
+    if encoding not in encodings or len(body) < min_size:
+        return body,None
+
+    if isinstance(obj, fragment):
+        return obj.compress(encoding, level),encoding
+
+    return compress(body, encoding, level),encoding
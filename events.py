@@ -0,0 +1,98 @@
+#!/usr/bin/env python2
+
+from threading import RLock as lock
+import logging
+import encode
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+class event_hub(object):
+    def __init__(self, subscribers=500, backlog=64, heartbeat=15):
+        self.max_subscribers = subscribers
+        self.backlog = backlog
+        self.heartbeat = heartbeat
+        self.lock = lock()
+        # queue -> callback run after something was put on it, so a
+        # server writing streams itself knows when to read
+        self.subscribers = {}
+
+    def subscribe(self, notify=None):
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+
+            q = queue.Queue(self.backlog)
+            self.subscribers[q] = notify
+
+        log.debug("subscribed ({} listeners)".format(len(self.subscribers)))
+
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.pop(q, None)
+
+    def publish(self, kind, data):
+        # encode once, no matter how many clients are listening
+        data = encode.encode(data).decode("utf-8")
+        message = "event: {}\ndata: {}\n\n".format(kind, data)
+
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+
+        for q,notify in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # a client this far behind has to reload anyway
+                log.warning("dropping slow event listener")
+                self.unsubscribe(q)
+                self.close_subscriber(q, notify)
+                continue
+
+            if notify:
+                notify()
+
+    def close_subscriber(self, q, notify=None):
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+
+        q.put_nowait(None)
+
+        if notify:
+            notify()
+
+    def stream(self, q):
+        try:
+            yield "retry: 5000\n\n"
+
+            while True:
+                try:
+                    message = q.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+
+                if message is None:
+                    break
+
+                yield message
+        finally:
+            self.unsubscribe(q)
+
+    def close(self):
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+            self.subscribers.clear()
+
+        for q,notify in subscribers:
+            self.close_subscriber(q, notify)
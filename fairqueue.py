@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+
+import logging
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+class fenwick(object):
+    def __init__(self, size=16):
+        self.tree = [0] * (size + 1)
+
+    def __len__(self):
+        return len(self.tree) - 1
+
+    def add(self, i, delta):
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def sum(self, i):
+        i = min(i, len(self.tree) - 1)
+        out = 0
+
+        while i > 0:
+            out += self.tree[i]
+            i -= i & -i
+
+        return out
+
+# Round-robin merge of per-user queues: a user with c upcoming tracks gets
+# the next one in round c, after every other user's track in rounds 0..c.
+# The number of tracks up to and including round c is the sum of
+# min(count, c + 1) over all users, which two fenwick trees indexed by
+# count answer in O(log n).
+class fair_queue(object):
+    def __init__(self, users=()):
+        self.reset(users)
+
+    def reset(self, users=()):
+        self.counts = {}
+        self.nusers = fenwick()
+        self.ntracks = fenwick()
+        self.active = 0
+
+        for user in users:
+            self.add(user)
+
+    def grow(self, count):
+        size = len(self.nusers)
+
+        if count <= size:
+            return
+
+        while size < count:
+            size *= 2
+
+        nusers = fenwick(size)
+        ntracks = fenwick(size)
+
+        for c in self.counts.values():
+            nusers.add(c, 1)
+            ntracks.add(c, c)
+
+        self.nusers = nusers
+        self.ntracks = ntracks
+
+    def update(self, user, delta):
+        old = self.counts.get(user, 0)
+        new = old + delta
+
+        if new < 0:
+            log.warning("user {} has no queued tracks to remove".format(user))
+            return
+
+        self.grow(new)
+
+        if old:
+            self.nusers.add(old, -1)
+            self.ntracks.add(old, -old)
+        else:
+            self.active += 1
+
+        if new:
+            self.nusers.add(new, 1)
+            self.ntracks.add(new, new)
+            self.counts[user] = new
+        else:
+            self.active -= 1
+            del self.counts[user]
+
+    def add(self, user):
+        self.update(user, 1)
+
+    def remove(self, user):
+        self.update(user, -1)
+
+    def count(self, user):
+        return self.counts.get(user, 0)
+
+    def position(self, user):
+        # offset into the upcoming queue for the next track of user
+        rounds = self.counts.get(user, 0) + 1
+        below = self.nusers.sum(rounds - 1)
+
+        return self.ntracks.sum(rounds - 1) + rounds * (self.active - below)
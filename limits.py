@@ -0,0 +1,92 @@
+#!/usr/bin/env python2
+
+from threading import BoundedSemaphore as semaphore
+from threading import RLock as lock
+from collections import OrderedDict
+import logging
+import math
+import time
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+class token_bucket(object):
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self):
+        # seconds until a token is available
+        if self.tokens >= 1:
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+# One bucket per route class and user id, and another per route class
+# and client address, so neither a single phone nor a single id can use
+# up a route for everyone else.
+class rate_limiter(object):
+    def __init__(self, budgets, size=10000):
+        self.budgets = budgets
+        self.size = size
+        self.lock = lock()
+        self.buckets = OrderedDict()
+
+    def bucket(self, key, budget, now):
+        bucket = self.buckets.pop(key, None)
+
+        if bucket is None:
+            bucket = token_bucket(budget["rate"], budget["burst"], now)
+
+        # idle buckets are full again anyway, so dropping the oldest is free
+        self.buckets[key] = bucket
+
+        while len(self.buckets) > self.size:
+            self.buckets.popitem(last=False)
+
+        return bucket
+
+    def check(self, route, user_id, address):
+        budget = self.budgets.get(route)
+
+        if not budget:
+            return 0
+
+        now = time.time()
+        keys = [(route, "id", user_id), (route, "ip", address)]
+
+        with self.lock:
+            buckets = [self.bucket(key, budget, now) for key in keys if key[2] is not None]
+
+            for bucket in buckets:
+                bucket.refill(now)
+
+            # a rejected request costs nothing from either budget
+            wait = max([bucket.wait() for bucket in buckets] + [0])
+
+            if not wait:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+
+        return int(math.ceil(wait))
+
+class admission(object):
+    # caps requests working against the spotify session at once
+    def __init__(self, limit):
+        self.limit = limit
+        self.slots = semaphore(limit) if limit else None
+
+    def acquire(self):
+        return self.slots is None or self.slots.acquire(False)
+
+    def release(self):
+        if self.slots is not None:
+            self.slots.release()
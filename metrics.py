@@ -0,0 +1,177 @@
+#!/usr/bin/env python2
+
+from threading import RLock as lock
+from contextlib import contextmanager
+import bisect
+import time
+
+buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name,value in zip(names, values)]
+
+    return "{" + ",".join(pairs) + "}"
+
+class metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def render(self):
+        out = ["# HELP {} {}".format(self.name, self.help),
+               "# TYPE {} {}".format(self.name, self.kind)]
+
+        with self.lock:
+            for key,value in sorted(self.values.items()):
+                out.extend(self.samples(key, value))
+
+        return out
+
+    def samples(self, key, value):
+        return ["{}{} {}".format(self.name, format_labels(self.labels, key), value)]
+
+class counter(metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class gauge(metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class histogram(metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=buckets):
+        metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            counts,total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self, key, value):
+        counts,total = value
+        names = self.labels + ("le",)
+        out = []
+        cumulative = 0
+
+        for bound,count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            labels = format_labels(names, key + (bound,))
+            out.append("{}_bucket{} {}".format(self.name, labels, cumulative))
+
+        labels = format_labels(self.labels, key)
+        out.append("{}_sum{} {}".format(self.name, labels, total))
+        out.append("{}_count{} {}".format(self.name, labels, cumulative))
+
+        return out
+
+class registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, m):
+        self.metrics.append(m)
+        return m
+
+    def counter(self, name, help, labels=()):
+        return self.add(counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=buckets):
+        return self.add(histogram(name, help, labels, buckets))
+
+    def render(self):
+        out = []
+
+        for m in self.metrics:
+            out.extend(m.render())
+
+        return "\n".join(out) + "\n"
+
+default = registry()
+
+http_requests = default.counter("sbox_http_requests_total",
+                                "HTTP requests handled",
+                                ("endpoint", "method", "status"))
+http_latency = default.histogram("sbox_http_request_seconds",
+                                 "HTTP request latency",
+                                 ("endpoint",))
+http_rejected = default.counter("sbox_http_rejected_total",
+                                "HTTP requests shed by rate limits and admission control",
+                                ("endpoint", "reason"))
+http_inflight = default.gauge("sbox_http_requests_in_flight",
+                              "HTTP requests being handled",
+                              ("endpoint",))
+spotify_latency = default.histogram("sbox_spotify_seconds",
+                                    "Time spent waiting on libspotify",
+                                    ("op", "type"))
+transition_gap = default.histogram("sbox_track_transition_seconds",
+                                   "Time from end of track to the next track playing",
+                                   buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+playlist_archived = default.counter("sbox_playlist_archived_total",
+                                    "Played tracks moved from the playlist to the history")
+cache_entries = default.gauge("sbox_cache_entries",
+                              "Entries held by a cache",
+                              ("cache",))
+cache_hits = default.counter("sbox_cache_hits_total",
+                             "Cache lookups answered from the cache",
+                             ("cache",))
+cache_misses = default.counter("sbox_cache_misses_total",
+                               "Cache lookups that missed",
+                               ("cache",))
+startup = default.gauge("sbox_startup_seconds",
+                        "Time from start until a startup stage was reached",
+                        ("stage",))
+spotify_commands = default.counter("sbox_spotify_commands_total",
+                                   "Session commands run by the command queue",
+                                   ("op",))
+spotify_queue_latency = default.histogram("sbox_spotify_queue_seconds",
+                                          "Time session commands wait in the command queue",
+                                          ("op",))
+spotify_queued = default.gauge("sbox_spotify_queued_commands",
+                               "Session commands waiting in the command queue")
@@ -1,21 +1,17 @@
 #!/usr/bin/env python2
 
-from threading import Thread as thread
-from threading import Event as event
 import pybonjour
 import logging
-import select
 import sys
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
 class publish(object):
-    def __init__(self, config):
-        self.stopping = event()
+    def __init__(self, config, reactor):
         self.config = config
+        self.reactor = reactor
         self.zeroconf = None
-        self.setup()
 
     def registered(self, zeroconf, flags, errorCode, name, regtype, domain):
         if errorCode == pybonjour.kDNSServiceErr_NoError:
@@ -37,28 +33,24 @@ class publish(object):
                                                      port=port,
                                                      callBack=self.registered,
                                                      txtRecord=txt_record)
+        self.reactor.add_reader(self.zeroconf, self.process)
 
-    def run(self):
-        while not self.stopping.is_set():
-            ready = select.select([self.zeroconf], [], [], .1)
+    def process(self):
+        pybonjour.DNSServiceProcessResult(self.zeroconf)
 
-            if self.stopping.is_set():
-                break
+    def teardown(self):
+        if not self.zeroconf:
+            return
 
-            if self.zeroconf in ready[0]:
-                pybonjour.DNSServiceProcessResult(self.zeroconf)
+        self.reactor.remove_reader(self.zeroconf)
+        self.zeroconf.close()
+        self.zeroconf = None
 
     def start(self):
-        self.thread = thread(None, self.run, "publish")
-        self.thread.start()
+        # registering can take a while, so it is done off the startup path
+        self.reactor.call_soon(self.setup)
         log.debug("started")
 
     def stop(self):
-        if not self.zeroconf:
-            return
-
-        self.stopping.set()
-        self.zeroconf.close()
-        self.zeroconf = None
-        self.thread.join()
+        self.reactor.call_sync(self.teardown)
         log.debug("stopped")
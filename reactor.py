@@ -0,0 +1,177 @@
+#!/usr/bin/env python2
+
+from threading import RLock as lock
+from threading import Event as event
+from threading import current_thread
+import logging
+import select
+import heapq
+import errno
+import time
+import os
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# One thread sleeping in select() until a registered socket is readable,
+# the earliest timer is due or another thread hands it work through the
+# wakeup pipe. Nothing wakes up on a fixed interval.
+class reactor(object):
+    def __init__(self):
+        self.lock = lock()
+        self.readers = {}
+        self.timers = []
+        self.ready = []
+        self.seq = 0
+        self.woken = False
+        self.stopping = False
+        self.thread = None
+        self.wake_r,self.wake_w = os.pipe()
+
+    def wake(self):
+        with self.lock:
+            if self.woken or self.wake_w is None:
+                return
+
+            self.woken = True
+            os.write(self.wake_w, b"x")
+
+    def add_reader(self, fileobj, callback):
+        with self.lock:
+            self.readers[fileobj] = callback
+
+        self.wake()
+
+    def remove_reader(self, fileobj):
+        with self.lock:
+            self.readers.pop(fileobj, None)
+
+        self.wake()
+
+    def call_soon(self, callback, *args):
+        # safe to call from any thread
+        with self.lock:
+            self.ready.append((callback, args))
+
+        self.wake()
+
+    def call_later(self, delay, callback, *args):
+        with self.lock:
+            self.seq += 1
+            timer = [time.time() + delay, self.seq, callback, args]
+            heapq.heappush(self.timers, timer)
+
+        self.wake()
+
+        return timer
+
+    def cancel(self, timer):
+        if timer:
+            timer[2] = None
+
+    def call_sync(self, callback, *args):
+        # run callback on the reactor thread and wait for it
+        if self.thread is None or self.thread is current_thread() or self.stopping:
+            return callback(*args)
+
+        done = event()
+        out = []
+
+        def run():
+            try:
+                out.append(callback(*args))
+            finally:
+                done.set()
+
+        self.call_soon(run)
+        done.wait()
+
+        return out[0] if out else None
+
+    def timeout(self):
+        with self.lock:
+            if self.ready or self.stopping:
+                return 0
+
+            while self.timers and self.timers[0][2] is None:
+                heapq.heappop(self.timers)
+
+            if not self.timers:
+                return None
+
+            return max(self.timers[0][0] - time.time(), 0)
+
+    def select(self, timeout):
+        with self.lock:
+            readers = dict(self.readers)
+
+        try:
+            ready = select.select([self.wake_r] + list(readers), [], [], timeout)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+
+            raise
+
+        if self.wake_r in ready:
+            os.read(self.wake_r, 4096)
+
+            with self.lock:
+                self.woken = False
+
+        return [(fileobj, readers[fileobj]) for fileobj in ready if fileobj in readers]
+
+    def dispatch(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            log.exception("reactor callback failed")
+
+    def run_timers(self):
+        now = time.time()
+        due = []
+
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                timer = heapq.heappop(self.timers)
+
+                if timer[2] is not None:
+                    due.append(timer)
+
+        for when,seq,callback,args in due:
+            self.dispatch(callback, *args)
+
+    def run(self):
+        self.thread = current_thread()
+        log.debug("started")
+
+        while True:
+            for fileobj,callback in self.select(self.timeout()):
+                # a reader removed by an earlier callback is skipped
+                if fileobj in self.readers:
+                    self.dispatch(callback)
+
+            self.run_timers()
+
+            with self.lock:
+                ready,self.ready = self.ready,[]
+                stopping = self.stopping
+
+            for callback,args in ready:
+                self.dispatch(callback, *args)
+
+            if stopping:
+                break
+
+        with self.lock:
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+            self.wake_w = None
+
+        log.debug("done")
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+
+        self.wake()
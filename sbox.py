@@ -1,16 +1,19 @@
 #!/usr/bin/env python2
 
 import os
-import yaml
-import time
+import signal
 import logging
 import argparse
 
 from sboxify import sboxify
 from service import service
 from publish import publish
+from store import state_store
+from store import atomic_dump
+from store import safe_load
 
 logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger(__name__)
 
 parser = argparse.ArgumentParser(description='Spotify distributed jukebox')
 parser.add_argument('--config', default="config.yaml", help='sbox config file (yaml)')
@@ -23,49 +26,88 @@ class sbox:
         self.config = sbox_config(args)
         self.sboxify = sboxify(self.config)
         self.service = service(self.config, self.sboxify)
-        self.publish = publish(self.config)
+        self.publish = publish(self.config, self.sboxify.reactor)
 
     def start(self):
-        self.sboxify.start()
+        # nothing here blocks: the server is up first, so the playlist
+        # snapshot can be served while logging in and registering
+        self.config.start()
         self.service.start()
+        self.sboxify.start()
         self.publish.start()
 
     def stop(self):
         self.publish.stop()
         self.service.stop()
         self.sboxify.stop()
+        self.config.stop()
 
 class sbox_config(object):
+    state_keys = ("spotify_index", "spotify_playlist")
+
     def __init__(self, args):
         self.args = vars(args)
-        self.config = yaml.load(open(args.config))
+        self.config = safe_load(args.config)
+        self.state = state_store(self.config.get("state_file", "state.yaml"),
+                                 self.config.get("state_delay", 1))
+        defaults = dict((k, self.config[k]) for k in self.state_keys if k in self.config)
+        state = self.state.load(defaults)
+
+        # once saved, runtime state wins over the config file; the index
+        # moves with every track, so only a different playlist is noted
+        key = "spotify_playlist"
+
+        if key in defaults and state[key] != defaults[key]:
+            log.info("{} from {} overrides {}: {}".format(key, self.state.path, args.config, state[key]))
+
+    def start(self):
+        self.state.start()
+
+    def stop(self):
+        self.state.stop()
 
     def __getattr__(self, key):
         if key in self.args and self.args[key]:
             return self.args[key]
 
+        if key in self.state:
+            return self.state.get(key)
+
         if key in self.config:
             return self.config[key]
 
         raise AttributeError(key)
 
+    def get(self, key, default=None):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            return default
+
     def __setattr__(self, key, value):
-        if key in ("args", "config"):
+        if key in ("args", "config", "state"):
             self.__dict__[key] = value
             return
 
+        if key in self.state_keys:
+            self.state.set(key, value)
+            return
+
         if key not in self.config:
             raise AttributeError(key)
 
         self.config[key] = value
-        yaml.dump(self.config, open(self.args['config'], 'w'))
+        atomic_dump(self.config, self.args['config'])
 
 if __name__ == "__main__":
     s = sbox(args)
     s.start()
 
+    # sleep until SIGINT or SIGTERM instead of waking up every second
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
     try:
         while True:
-            time.sleep(1)
+            signal.pause()
     except KeyboardInterrupt:
         s.stop()
@@ -1,11 +1,40 @@
 #!/usr/bin/env python2
 
-import os
-import yaml
+import time
 import logging
+import re
+import bisect
+import difflib
 import spotify
+import metrics
+from cache import lru_cache
+from cache import disk_cache
+from store import user_journal
+from store import history_store
+from store import snapshot_dump
+from store import snapshot_load
+from fairqueue import fair_queue
+from events import event_hub
+from reactor import reactor
+from session_queue import command_queue
+import session_queue
+from encode import fragment
 from threading import Event as event
+from threading import Condition as condition
+from threading import RLock as lock
 from threading import Thread as thread
+from collections import deque
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from PIL import Image as pil
+    from io import BytesIO
+except ImportError:
+    pil = None
 
 slog = logging.getLogger("spotify")
 slog.setLevel(logging.INFO)
@@ -13,35 +42,87 @@ slog.setLevel(logging.INFO)
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+def remaining(deadline):
+    # what is left of a request deadline, for waits on the session queue
+    return None if deadline is None else max(deadline - time.time(), 0)
+
 class sboxify(object):
     event_logged_in = event()
-    event_stop = event()
 
     def __init__(self, config):
+        self.started = time.time()
+        self.stages = set()
         self.config = config
+        self.reactor = reactor()
+        self.timer = None
         self.session = spotify.Session()
-        self.playlist = sboxify_playlist(self.session, config)
-        self.player = sboxify_player(self.session, self.playlist, config)
+        sboxify_dictify.setup(self.session, config)
+        self.commands = command_queue()
+        self.searches = sboxify_searches(self.session, config, self.commands)
+        self.images = disk_cache(config.get("image_cache_dir", "images"),
+                                 config.get("image_cache_size", 100 * 1024 * 1024))
+        self.image_sizes = set(config.get("image_sizes", [64, 160, 300, 640]))
+        self.image_lock = lock()
+        self.image_fetches = {}
+        self.request_timeout = config.get("request_deadline", 2)
+        self.events = event_hub(config.get("events_max", 500),
+                                config.get("events_backlog", 64),
+                                config.get("events_heartbeat", 15))
+        self.playlist = sboxify_playlist(self.session, config, self.events, self.commands)
+        self.player = sboxify_player(self.session, self.playlist, config, self.events, self.commands)
+        self.browser = sboxify_browser(self.session, self.playlist, config, self.commands)
 
     def stop(self):
-        self.event_stop.set()
+        self.events.close()
+        self.reactor.stop()
         self.thread.join()
+        self.browser.stop()
+        self.playlist.stop()
+        self.commands.stop()
         log.debug("stopped")
 
     def start(self):
+        self.commands.start()
+        self.browser.start()
+
+        # user list and snapshot are read while logging in
+        local = thread(None, self.load_local, "sboxify local state")
+        local.daemon = True
+        local.start()
+
         self.thread = thread(None, self.run, "sboxify")
         self.thread.start()
         log.debug("started")
 
+    def load_local(self):
+        if self.playlist.load_local():
+            self.startup("snapshot")
+
+    def startup(self, stage):
+        if stage in self.stages:
+            return
+
+        self.stages.add(stage)
+        elapsed = time.time() - self.started
+        metrics.startup.set(elapsed, stage=stage)
+        log.info("startup: {} after {:.3f}s".format(stage, elapsed))
+
     def run(self):
+        # libspotify asks for process_events() from its own threads
+        self.session.on(spotify.SessionEvent.NOTIFY_MAIN_THREAD, self.on_notify_main_thread)
         self.login()
-        self.loop = spotify.EventLoop(self.session)
-        self.loop.start()
+        self.reactor.call_soon(self.process_events)
+        self.reactor.run()
+        log.debug("done")
 
-        while not self.event_stop.wait(.1):
-            continue
+    def on_notify_main_thread(self, session):
+        self.reactor.call_soon(self.process_events)
 
-        log.debug("done")
+    def process_events(self):
+        # libspotify tells us when it next wants to be called
+        timeout = self.session.process_events()
+        self.reactor.cancel(self.timer)
+        self.timer = self.reactor.call_later(timeout / 1000.0, self.process_events)
 
     def login(self):
         self.session.on(
@@ -54,21 +135,42 @@ class sboxify(object):
     def is_logged_in(self):
         return self.event_logged_in.is_set()
 
+    def is_readable(self):
+        # the playlist can be read from the snapshot before login
+        return self.is_logged_in() or self.playlist.warm.is_set()
+
     def on_logged_in(self, session):
         if not self.session.connection.state is spotify.ConnectionState.LOGGED_IN:
             return
 
-        self.event_logged_in.set()
         log.debug("logged in")
+
+        # loading and reconciling the playlist blocks, and the reactor has
+        # to keep accepting connections and processing events meanwhile
+        handler = thread(None, self.handle_logged_in, "sboxify login")
+        handler.daemon = True
+        handler.start()
+
+    def handle_logged_in(self):
         self.playlist.handle_logged_in()
         self.player.handle_logged_in()
 
+        # only serve requests once the playlist mirror is loaded
+        self.event_logged_in.set()
+        self.startup("logged_in")
+        self.browser.warm_playlist()
+
+    def deadline(self):
+        # shared by everything a request loads, so slow entities come
+        # back as pending placeholders instead of stalling the response
+        return sboxify_dictify.loader.deadline(self.request_timeout)
+
     def search(self, query):
         if not 'q' in query:
             log.warning("search query did not contain a q element: {}".format(query))
             return {"error": "specify search query as 'q'"}
 
-        search = sboxify_search(self.session, **query)
+        search = sboxify_search(self.searches, self.deadline(), **query)
 
         return search.result()
 
@@ -84,7 +186,7 @@ class sboxify(object):
         uri = query["key"]
         user_id = query["id"]
 
-        return self.playlist.add_track(uri, user_id)
+        return self.playlist.add_track(uri, user_id, self.deadline())
 
     def playlist_remove(self, query):
         if not "key" in query:
@@ -98,48 +200,229 @@ class sboxify(object):
         uri = query["key"]
         user_id = query["id"]
 
-        return self.playlist.remove_track(uri, user_id)
+        return self.playlist.remove_track(uri, user_id, self.deadline())
 
+    def batch_keys(self, query):
+        keys = query.get("keys")
+
+        if isinstance(keys, list):
+            return keys
+
+        if keys:
+            return [key for key in keys.split(",") if key]
+
+        return None
+
+    def playlist_add_batch(self, query):
+        keys = self.batch_keys(query)
+
+        if not keys:
+            log.warning("add query did not contain a 'keys' element: {}".format(query))
+            return {"error": "specify keys in query"}
+
+        if not "id" in query:
+            log.warning("add query did not contain a 'id' element: {}".format(query))
+            return {"error": "specify id in query"}
+
+        return {"results": self.playlist.add_tracks(keys, query["id"], self.deadline())}
+
+    def playlist_remove_batch(self, query):
+        keys = self.batch_keys(query)
+
+        if not keys:
+            log.warning("remove query did not contain a 'keys' element: {}".format(query))
+            return {"error": "specify keys in query"}
+
+        if not "id" in query:
+            log.warning("remove query did not contain a 'id' element: {}".format(query))
+            return {"error": "specify id in query"}
+
+        return {"results": self.playlist.remove_tracks(keys, query["id"], self.deadline())}
 
     def playlist_get(self, query):
+        try:
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", 0)) or None
+            since = query.get("since")
+            version = None if since is None else self.playlist.parse_version(since)
+        except ValueError:
+            log.warning("playlist query contains invalid numbers: {}".format(query))
+            return {"error": "specify offset and limit as numbers and since as a playlist version"}
+
         data = {}
-        data["tracks"] = self.playlist.get_tracks()
+        deadline = self.deadline()
+
+        if not self.is_logged_in():
+            data["snapshot"] = True
+
+        with self.playlist.lock:
+            data["version"] = self.playlist.version_token()
+            data["index"] = self.playlist.index
+            data["total"] = self.playlist.get_length()
+            changes = None
+
+            # a version from another process gets a full listing
+            if version is not None:
+                changes = self.playlist.get_changes(version)
+
+            if changes is None:
+                tracks = self.playlist.get_tracks(offset, limit)
+            else:
+                data["changes"] = changes
+
+        if changes is None:
+            data["offset"] = offset
+            data["tracks"] = self.playlist.props(tracks, deadline)
 
         if "id" in query:
-            data["user_tracks"] = self.playlist.get_user_tracks(query["id"])
+            data["user_tracks"] = self.playlist.get_user_tracks(query["id"], deadline)
+
+        if sboxify_dictify.pending(data.get("tracks", []) + data.get("user_tracks", [])):
+            data["pending"] = True
 
         return data
 
-    def artist_get(self, query):
+    def playlist_etag(self, query):
+        return "playlist-{}-{}".format(self.playlist.epoch, self.playlist.version)
+
+    def browse_etag(self, kind, query):
         if not "key" in query:
-            log.warning("add query did not contain a 'key' element: {}".format(query))
-            return {"error": "specify key in query"}
+            return None
 
-        uri = query["key"]
-        artist = self.session.get_artist(uri)
-        browser = artist.browse().load()
+        return "{}-{}-{}".format(kind, self.browser.cache.generation, query["key"])
 
-        out = {
-                "albums": sboxify_dictify.albums(browser.albums),
-                "tracks": sboxify_dictify.tracks(browser.tracks),
-            }
+    def search_etag(self, query):
+        if not 'q' in query:
+            return None
 
-        return out
+        # results change when the cached search is refreshed
+        q = self.searches.normalize(query["q"])
+        expires = self.searches.cache.expires(q)
 
-    def album_get(self, query):
+        if expires is None:
+            return None
+
+        flags = ",".join(sorted(key for key in query if key != "q"))
+
+        return "search-{}-{!r}-{}-{}".format(self.searches.cache.generation, expires, flags, q)
+
+    def image_get(self, image_id, query):
+        if not re.match("^[0-9a-zA-Z]+$", image_id):
+            return None
+
+        try:
+            size = int(query.get("size", 0))
+        except ValueError:
+            size = 0
+
+        # only a few thumbnail sizes are made; anything else gets the original
+        if size in self.image_sizes and pil:
+            name = "{}-{}".format(image_id, size)
+        else:
+            name = image_id
+
+        data = self.images.get(name)
+
+        if data is not None:
+            return data
+
+        deadline = self.deadline()
+        data = self.images.get(image_id)
+
+        if data is None:
+            data = self.shared(deadline, image_id, self.load_image, image_id, deadline)
+
+        if data is None or name == image_id:
+            return data
+
+        return self.shared(deadline, name, self.thumbnail, name, data, size)
+
+    def shared(self, deadline, key, func, *args):
+        # concurrent misses for one image share a single fetch or resize
+        with self.image_lock:
+            fetch = self.image_fetches.get(key)
+            owner = fetch is None
+
+            if owner:
+                fetch = self.image_fetches[key] = session_queue.future()
+
+        if not owner:
+            try:
+                return fetch.result(remaining(deadline))
+            except session_queue.command_timeout:
+                return None
+
+        try:
+            fetch.set_result(func(*args))
+        except Exception as e:
+            fetch.set_exception(e)
+        finally:
+            with self.image_lock:
+                del self.image_fetches[key]
+
+        return fetch.result()
+
+    def load_image(self, image_id, deadline):
+        started = self.commands.submit(session_queue.IMAGE, "image", self.session.get_image,
+                                       "spotify:image:" + image_id)
+
+        try:
+            image = started.result(remaining(deadline))
+        except session_queue.command_timeout:
+            log.warning("image not started in time: {}".format(image_id))
+            return None
+
+        if sboxify_dictify.loader.load([image], deadline):
+            log.warning("image not loaded in time: {}".format(image_id))
+            return None
+
+        return self.images.put(image_id, image.data)
+
+    def thumbnail(self, name, data, size):
+        thumb = pil.open(BytesIO(data))
+        thumb.thumbnail((size, size))
+        out = BytesIO()
+        thumb.convert("RGB").save(out, "JPEG", quality=85)
+
+        return self.images.put(name, out.getvalue())
+
+    def history_get(self, query):
+        try:
+            before = query.get("before")
+            before = None if before is None else int(before)
+            limit = max(1, min(int(query.get("limit", 50)), 500))
+        except ValueError:
+            log.warning("history query contains invalid numbers: {}".format(query))
+            return {"error": "specify before and limit as numbers"}
+
+        tracks = self.playlist.get_history(before, limit, self.deadline())
+        data = {"total": self.playlist.history.count, "tracks": tracks}
+
+        # the index of the oldest entry returned pages further back
+        if tracks and tracks[-1]["index"] > 0:
+            data["next"] = tracks[-1]["index"]
+
+        if sboxify_dictify.pending([record["track"] for record in tracks]):
+            data["pending"] = True
+
+        return data
+
+    def player_get(self, query):
+        return self.player.status()
+
+    def artist_get(self, query):
         if not "key" in query:
             log.warning("add query did not contain a 'key' element: {}".format(query))
             return {"error": "specify key in query"}
 
-        uri = query["key"]
-        album = self.session.get_album(uri)
-        browser = album.browse().load()
+        return self.browser.get("artist", query["key"], self.deadline())
 
-        out = {
-                "tracks": sboxify_dictify.tracks(browser.tracks),
-            }
+    def album_get(self, query):
+        if not "key" in query:
+            log.warning("add query did not contain a 'key' element: {}".format(query))
+            return {"error": "specify key in query"}
 
-        return out
+        return self.browser.get("album", query["key"], self.deadline())
 
     def control(self, action, query):
         if action == "pause":
@@ -156,19 +439,158 @@ class sboxify(object):
 
         return {"control": False, "action": action}
 
+    def caches(self):
+        return sboxify_dictify.stats() + [self.searches.cache.stats(),
+                                          self.browser.cache.stats(),
+                                          self.images.stats()]
+
+    def cache(self, action, query):
+        if action == "flush":
+            sboxify_dictify.flush()
+            self.searches.cache.flush()
+            self.browser.cache.flush()
+            return {"cache": True, "action": action}
+
+        if action == "stats":
+            return {"cache": True, "action": action, "caches": self.caches()}
+
+        return {"cache": False, "action": action}
+
+class sboxify_loader(object):
+    def __init__(self, session, timeout=10):
+        self.session = session
+        self.timeout = timeout
+        self.updated = condition()
+
+        session.on(spotify.SessionEvent.METADATA_UPDATED, self.on_metadata_updated)
+
+    def on_metadata_updated(self, session):
+        with self.updated:
+            self.updated.notify_all()
+
+    def deadline(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        return time.time() + timeout
+
+    def load(self, objs, deadline=None):
+        # wait for all objs at once, returning the ones still pending at deadline
+        if deadline is None:
+            deadline = self.deadline()
+
+        pending = [obj for obj in objs if obj is not None and not obj.is_loaded]
+
+        if not pending:
+            return pending
+
+        kind = type(pending[0]).__name__.lower()
+
+        with metrics.spotify_latency.time(op="batch", type=kind), self.updated:
+            while pending:
+                remaining = deadline - time.time()
+
+                if remaining <= 0:
+                    log.warning("{} objects not loaded before deadline".format(len(pending)))
+                    break
+
+                # images do not emit metadata updates, so re-check now and then
+                self.updated.wait(min(remaining, .1))
+                pending = [obj for obj in pending if not obj.is_loaded]
+
+        return pending
+
 class sboxify_dictify(object):
+    caches = {}
+    loader = None
+
+    @staticmethod
+    def setup(session, config):
+        timeout = config.get("spotify_timeout", 10)
+        sboxify_dictify.loader = sboxify_loader(session, timeout)
+        size = config.get("cache_size", 5000)
+        ttl = config.get("cache_ttl", {})
+
+        for kind in ("track", "album", "artist"):
+            cache = lru_cache(kind, size, ttl.get(kind, 3600))
+            sboxify_dictify.caches[kind] = cache
+
     @staticmethod
-    def track_props(track):
-        track.load()
-        image = track.album.cover()
+    def cached(kind, obj, props, ready=None):
+        cache = sboxify_dictify.caches.get(kind)
+        uri = obj.link.uri
+        out = cache.get(uri) if cache else None
+
+        if out is not None:
+            return out
 
-        if image:
-            image = image.load().link.url
+        # placeholders are never cached, the next request tries again
+        if ready is not None and not ready(obj):
+            return sboxify_dictify.placeholder(obj)
+
+        if cache is None:
+            return props(obj)
+
+        return cache.put(uri, fragment(props(obj)))
+
+    @staticmethod
+    def prime(kind, uri, props):
+        cache = sboxify_dictify.caches.get(kind)
+        props = fragment(props)
+
+        if cache is None:
+            return props
+
+        return cache.put(uri, props)
+
+    @staticmethod
+    def placeholder(obj):
+        return {"key": obj.link.uri, "pending": True}
+
+    @staticmethod
+    def pending(props):
+        return any(item.get("pending") for item in props)
+
+    @staticmethod
+    def flush():
+        for cache in sboxify_dictify.caches.values():
+            cache.flush()
+
+    @staticmethod
+    def stats():
+        return [cache.stats() for cache in sboxify_dictify.caches.values()]
+
+    @staticmethod
+    def load(obj):
+        if obj.is_loaded:
+            return obj
+
+        with metrics.spotify_latency.time(op="load", type=type(obj).__name__.lower()):
+            return obj.load()
+
+    @staticmethod
+    def track_props(track, bounded=False):
+        ready = sboxify_dictify.track_ready if bounded else None
+
+        return sboxify_dictify.cached("track", track, sboxify_dictify.load_track_props, ready)
+
+    @staticmethod
+    def track_ready(track):
+        if not track.is_loaded or not track.album.is_loaded:
+            return False
+
+        return all(artist.is_loaded for artist in track.artists)
+
+    @staticmethod
+    def load_track_props(track):
+        sboxify_dictify.load(track)
+        album = sboxify_dictify.load(track.album)
+        image = sboxify_dictify.image_ref(album.cover())
 
         props = {
                 "key": track.link.uri,
-                "album": (track.album.link.uri, track.album.load().name),
-                "artists": [(artist.link.uri, artist.load().name) for artist in track.artists],
+                "album": (album.link.uri, album.name),
+                "artists": [(artist.link.uri, sboxify_dictify.load(artist).name) for artist in track.artists],
                 "duration": track.duration,
                 "name": track.name,
                 "popularity": track.popularity,
@@ -178,26 +600,92 @@ class sboxify_dictify(object):
         return props
 
     @staticmethod
-    def tracks(tracks):
+    def uncached(kind, objs):
+        cache = sboxify_dictify.caches.get(kind)
+
+        if cache is None:
+            return objs
+
+        return [obj for obj in objs if obj.link.uri not in cache]
+
+    @staticmethod
+    def image_ref(image):
+        # resolved lazily by /image, so listings never wait for image data
+        if not image:
+            return None
+
+        return "/image/" + image.link.uri.split(":")[-1]
+
+    @staticmethod
+    def load_tracks(tracks, deadline=None):
+        loader = sboxify_dictify.loader
+
+        if not loader or not tracks:
+            return
+
+        if deadline is None:
+            deadline = loader.deadline()
+
+        loader.load(tracks, deadline)
+
+        albums = [track.album for track in tracks if track.is_loaded]
+        artists = [artist for track in tracks if track.is_loaded for artist in track.artists]
+        loader.load(albums + artists, deadline)
+
+    @staticmethod
+    def load_albums(albums, deadline=None):
+        loader = sboxify_dictify.loader
+
+        if not loader or not albums:
+            return
+
+        if deadline is None:
+            deadline = loader.deadline()
+
+        loader.load(albums, deadline)
+
+        artists = [album.artist for album in albums if album.is_loaded]
+        loader.load(artists, deadline)
+
+    @staticmethod
+    def load_artists(artists, deadline=None):
+        loader = sboxify_dictify.loader
+
+        if not loader or not artists:
+            return
+
+        loader.load(artists, deadline)
+
+    @staticmethod
+    def tracks(tracks, deadline=None):
         out = []
+        tracks = list(tracks)
+        sboxify_dictify.load_tracks(sboxify_dictify.uncached("track", tracks), deadline)
 
         for track in tracks:
-            props = sboxify_dictify.track_props(track)
+            props = sboxify_dictify.track_props(track, deadline is not None)
             out.append(props)
 
         return out
 
     @staticmethod
-    def album_props(album):
-        album.load()
-        image = album.cover()
+    def album_props(album, bounded=False):
+        ready = sboxify_dictify.album_ready if bounded else None
+
+        return sboxify_dictify.cached("album", album, sboxify_dictify.load_album_props, ready)
+
+    @staticmethod
+    def album_ready(album):
+        return album.is_loaded and album.artist.is_loaded
 
-        if image:
-            image = image.load().link.url
+    @staticmethod
+    def load_album_props(album):
+        sboxify_dictify.load(album)
+        image = sboxify_dictify.image_ref(album.cover())
 
         props = {
                 "key": album.link.uri,
-                "artist": album.artist.load().name,
+                "artist": sboxify_dictify.load(album.artist).name,
                 "year": album.year,
                 "type": album.type,
                 "name": album.name,
@@ -207,22 +695,31 @@ class sboxify_dictify(object):
         return props
 
     @staticmethod
-    def albums(albums):
+    def albums(albums, deadline=None):
         out = []
+        albums = list(albums)
+        sboxify_dictify.load_albums(sboxify_dictify.uncached("album", albums), deadline)
 
         for album in albums:
-            props = sboxify_dictify.album_props(album)
+            props = sboxify_dictify.album_props(album, deadline is not None)
             out.append(props)
 
         return out
 
     @staticmethod
-    def artist_props(artist):
-        artist.load()
-        image = artist.portrait()
+    def artist_props(artist, bounded=False):
+        ready = sboxify_dictify.artist_ready if bounded else None
+
+        return sboxify_dictify.cached("artist", artist, sboxify_dictify.load_artist_props, ready)
+
+    @staticmethod
+    def artist_ready(artist):
+        return artist.is_loaded
 
-        if image:
-            image = image.load().link.url
+    @staticmethod
+    def load_artist_props(artist):
+        sboxify_dictify.load(artist)
+        image = sboxify_dictify.image_ref(artist.portrait())
 
         props = {
                 "key": artist.link.uri,
@@ -233,24 +730,267 @@ class sboxify_dictify(object):
         return props
 
     @staticmethod
-    def artists(artists):
+    def artists(artists, deadline=None):
         out = []
+        artists = list(artists)
+        sboxify_dictify.load_artists(sboxify_dictify.uncached("artist", artists), deadline)
 
         for artist in artists:
-            props = sboxify_dictify.artist_props(artist)
+            props = sboxify_dictify.artist_props(artist, deadline is not None)
             out.append(props)
 
         return out
 
+class sboxify_searches(object):
+    # Suggest results are ranked and truncated, so a cached result for one
+    # query never answers another; only identical queries share work.
+    def __init__(self, session, config, commands):
+        self.session = session
+        self.commands = commands
+        self.timeout = config.get("spotify_timeout", 10)
+        self.cache = lru_cache("search",
+                               config.get("search_cache_size", 500),
+                               config.get("search_cache_ttl", 300))
+        self.max_inflight = config.get("search_inflight_size", 100)
+        self.lock = lock()
+        self.inflight = {}
+
+    @staticmethod
+    def normalize(q):
+        return " ".join(q.lower().split())
+
+    def search(self, q):
+        return self.session.search(q, search_type=spotify.SearchType.SUGGEST)
+
+    def sweep(self, now):
+        # typed prefixes are rarely asked for twice, so searches nobody
+        # came back for are cached once loaded or dropped once stale
+        for q,(started,started_search) in list(self.inflight.items()):
+            if started + self.timeout < now:
+                del self.inflight[q]
+            elif started_search.done.is_set():
+                if started_search.error is not None:
+                    del self.inflight[q]
+                elif started_search.value.is_loaded:
+                    del self.inflight[q]
+                    self.cache.put(q, started_search.value)
+
+        while self.inflight and len(self.inflight) >= self.max_inflight:
+            del self.inflight[min(self.inflight, key=lambda q: self.inflight[q][0])]
+
+    def get(self, q, deadline=None):
+        q = self.normalize(q)
+        search = self.cache.get(q)
+
+        if search is not None:
+            return search
+
+        with self.lock:
+            self.sweep(time.time())
+            started,started_search = self.inflight.get(q, (0, None))
+
+            # a search outliving the spotify timeout is given up on; the
+            # lock is not held while the session queue starts a new one
+            if started_search is None or started + self.timeout < time.time():
+                log.debug("starting search: {}".format(q))
+                started_search = self.commands.submit(session_queue.SEARCH, "search", self.search, q)
+                self.inflight[q] = (time.time(), started_search)
+            else:
+                log.debug("joining in-flight search: {}".format(q))
+
+        try:
+            search = started_search.result(remaining(deadline))
+        except session_queue.command_timeout:
+            # still queued; later requests for the query join it
+            return None
+        except Exception:
+            with self.lock:
+                self.inflight.pop(q, None)
+
+            raise
+
+        # the search keeps loading after a request gives up on it, so a
+        # later request for the same query picks up where this one left
+        with metrics.spotify_latency.time(op="search", type="suggest"):
+            pending = sboxify_dictify.loader.load([search], deadline)
+
+        if not pending:
+            with self.lock:
+                if self.inflight.get(q, (0, None))[1] is started_search:
+                    del self.inflight[q]
+                    self.cache.put(q, search)
+
+        return search
+
+class sboxify_browser(object):
+    def __init__(self, session, playlist, config, commands):
+        self.session = session
+        self.playlist = playlist
+        self.commands = commands
+        self.cache = lru_cache("browse",
+                               config.get("browse_cache_size", 200),
+                               config.get("browse_cache_ttl", 86400))
+        self.warm_limit = config.get("browse_warm_limit", 50)
+        self.timeout = config.get("spotify_timeout", 10)
+        self.max_browsing = config.get("browse_inflight_size", 100)
+        self.browsing = {}
+        self.queue = queue.Queue()
+        self.lock = lock()
+        self.pending = set()
+        self.stopping = event()
+        self.thread = None
+
+        playlist.listeners.append(self.on_playlist_changed)
+
+    def get(self, kind, uri, deadline=None, priority=session_queue.BROWSE):
+        out = self.cache.get(uri)
+
+        if out is not None:
+            return out
+
+        out = self.browse(kind, uri, deadline, priority)
+
+        # partial results are handed out but not kept
+        if out.get("pending"):
+            return out
+
+        return self.cache.put(uri, fragment(out))
+
+    def start_browse(self, kind, uri):
+        if kind == "artist":
+            return self.session.get_artist(uri).browse()
+
+        return self.session.get_album(uri).browse()
+
+    def sweep(self, now):
+        # finished browses are handed to the warmer, which caches them the
+        # next time round; stale ones are dropped
+        for uri,(started,started_browse,kind) in list(self.browsing.items()):
+            if started + self.timeout < now:
+                del self.browsing[uri]
+            elif started_browse.done.is_set():
+                if started_browse.error is not None:
+                    del self.browsing[uri]
+                elif started_browse.value.is_loaded:
+                    self.warm(kind, uri)
+
+        while self.browsing and len(self.browsing) >= self.max_browsing:
+            del self.browsing[min(self.browsing, key=lambda uri: self.browsing[uri][0])]
+
+    def browse(self, kind, uri, deadline=None, priority=session_queue.BROWSE):
+        with self.lock:
+            self.sweep(time.time())
+            started,started_browse,_ = self.browsing.get(uri, (0, None, kind))
+
+            # like searches, a browse keeps loading for the next request
+            if started_browse is None or started + self.timeout < time.time():
+                started_browse = self.commands.submit(priority, "browse", self.start_browse, kind, uri)
+                self.browsing[uri] = (time.time(), started_browse, kind)
+
+        try:
+            browser = started_browse.result(remaining(deadline))
+        except session_queue.command_timeout:
+            browser = None
+        except Exception:
+            with self.lock:
+                self.browsing.pop(uri, None)
+
+            raise
+
+        with metrics.spotify_latency.time(op="browse", type=kind):
+            pending = browser is None or sboxify_dictify.loader.load([browser], deadline)
+
+        if pending:
+            return {"key": uri, "pending": True, "tracks": []}
+
+        with self.lock:
+            if self.browsing.get(uri, (0, None, kind))[1] is started_browse:
+                del self.browsing[uri]
+
+        out = {"tracks": sboxify_dictify.tracks(browser.tracks, deadline)}
+
+        if kind == "artist":
+            out["albums"] = sboxify_dictify.albums(browser.albums, deadline)
+
+        if sboxify_dictify.pending(out["tracks"] + out.get("albums", [])):
+            out["pending"] = True
+
+        return out
+
+    def warm(self, kind, uri):
+        with self.lock:
+            if uri in self.pending or uri in self.cache:
+                return
+
+            self.pending.add(uri)
+
+        self.queue.put((kind, uri))
+
+    def warm_track(self, props):
+        self.warm("album", props["album"][0])
+
+        for uri,name in props["artists"]:
+            self.warm("artist", uri)
+
+    def warm_playlist(self):
+        self.queue.put(("playlist", None))
+
+    def on_playlist_changed(self, change):
+        if change["op"] == "add" and "track" in change and not change["track"].get("pending"):
+            self.warm_track(change["track"])
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+
+            # don't drain a long backlog of warm ups on shutdown
+            if item is None or self.stopping.is_set():
+                break
+
+            kind,uri = item
+
+            try:
+                if kind == "playlist":
+                    tracks = self.playlist.get_tracks(0, self.warm_limit)
+
+                    for props in self.playlist.props(tracks):
+                        if not props.get("pending"):
+                            self.warm_track(props)
+                else:
+                    self.get(kind, uri, priority=session_queue.WARM)
+                    log.debug("warmed {} browse: {}".format(kind, uri))
+            except Exception as e:
+                log.warning("failed to warm {} {}: {}".format(kind, uri, e))
+            finally:
+                with self.lock:
+                    self.pending.discard(uri)
+
+    def start(self):
+        self.thread = thread(None, self.run, "browse warmer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.queue.put(None)
+        self.thread.join()
+
 class sboxify_search(object):
-    def __init__(self, session, q, **kwargs):
+    def __init__(self, searches, deadline, q, **kwargs):
         self.kwargs = kwargs
-        self.search = session.search(q, search_type=spotify.SearchType.SUGGEST)
-        self.search.load()
+        self.deadline = deadline
+        self.search = searches.get(q, deadline)
 
     def result(self):
         result = {}
 
+        if self.search is None or not self.search.is_loaded:
+            result["pending"] = True
+            result.update((kind, []) for kind in ("albums", "artists", "tracks")
+                          if "no" + kind not in self.kwargs)
+
+            return result
+
         if "noalbums" not in self.kwargs:
             result["albums"] = self.albums()
 
@@ -260,43 +1000,400 @@ class sboxify_search(object):
         if "notracks" not in self.kwargs:
             result["tracks"] = self.tracks()
 
+        if sboxify_dictify.pending(result.get("albums", []) + result.get("artists", []) +
+                                   result.get("tracks", [])):
+            result["pending"] = True
+
         return result
 
     def tracks(self):
-        return sboxify_dictify.tracks(self.search.tracks)
+        return sboxify_dictify.tracks(self.search.tracks, self.deadline)
 
     def albums(self):
-        return sboxify_dictify.albums(self.search.albums)
+        return sboxify_dictify.albums(self.search.albums, self.deadline)
 
     def artists(self):
-        return sboxify_dictify.artists(self.search.artists)
+        return sboxify_dictify.artists(self.search.artists, self.deadline)
+
+class sboxify_entry(object):
+    __slots__ = ("uri", "user", "props", "played")
+
+    def __init__(self, uri, user, props=None):
+        self.uri = uri
+        self.user = user
+        self.props = props
+        self.played = None
 
 class sboxify_playlist(object):
-    def __init__(self, session, config):
+    def __init__(self, session, config, events, commands):
         self.session = session
         self.config = config
+        self.events = events
+        self.commands = commands
+        self.listeners = []
         self.index = config.spotify_index
+        self.lock = lock()
+        self.version = 0
+        # versions restart with the process, so tag them with its start
+        self.epoch = "{:x}".format(int(time.time() * 1000))
+        self.changes = deque(maxlen=config.get("playlist_changes", 256))
+        self.journal = user_journal(config.user_list,
+                                    config.get("user_list_sync", .5),
+                                    config.get("user_list_compact", 1000))
+        self.history = history_store(config.get("history_file", "history.jsonl"))
+        self.history_keep = config.get("history_keep", 100)
+        self.history_batch = config.get("history_batch", 50)
+        self.archiving = False
+        self.entries = []
+        self.user_positions = {}
+        self.uri_positions = {}
+        self.queue = fair_queue()
+        self.inflight = 0
+        self.snapshot_path = config.get("playlist_snapshot", "playlist.json")
+        self.loaded = event()
+        self.warm = event()
+        self.synced = False
+        self.updates = queue.Queue()
+        self.updater = None
+
+    def version_token(self):
+        return "{}-{}".format(self.epoch, self.version)
+
+    def parse_version(self, token):
+        # None for versions handed out before this process started
+        epoch,sep,version = str(token).rpartition("-")
+        version = int(version)
+
+        return version if epoch == self.epoch else None
+
+    def changed(self, op, **change):
+        with self.lock:
+            self.version += 1
+            change["op"] = op
+            change["version"] = self.version_token()
+            self.changes.append((self.version, change))
+            self.events.publish("playlist", change)
+
+            for listener in self.listeners:
+                listener(change)
+
+    def get_changes(self, since):
+        # None tells the caller to fall back to a full listing
+        with self.lock:
+            if since > self.version:
+                return None
+
+            if since == self.version:
+                return []
+
+            if not self.changes or self.changes[0][0] > since + 1:
+                return None
+
+            return [change for version,change in self.changes if version > since]
 
     def handle_logged_in(self):
         if not self.get_playlist():
             self.create_playlist()
 
+        self.loaded.wait()
         self.load_user_tracks()
 
+        # playlist callbacks run on the reactor thread, and applying them
+        # waits on the lock and the disk; one thread keeps them in order
+        self.updater = thread(None, self.run_updates, "playlist updates")
+        self.updater.daemon = True
+        self.updater.start()
+
+        self.playlist.on(spotify.PlaylistEvent.TRACKS_ADDED, self.on_tracks_added)
+        self.playlist.on(spotify.PlaylistEvent.TRACKS_REMOVED, self.on_tracks_removed)
+        self.playlist.on(spotify.PlaylistEvent.TRACKS_MOVED, self.on_tracks_moved)
+
+    def stop(self):
+        if self.updater is not None:
+            self.updates.put(None)
+            self.updater.join()
+
+        if self.synced:
+            self.save_snapshot()
+
+        self.journal.stop()
+
+    def load_local(self):
+        try:
+            self.journal.load()
+            self.journal.start()
+            self.history.load()
+
+            with self.lock:
+                self.index = max(self.index - self.journal.base, 0)
+
+            return self.load_snapshot()
+        finally:
+            self.loaded.set()
+
+    def load_snapshot(self):
+        snapshot = snapshot_load(self.snapshot_path)
+
+        if not snapshot:
+            return False
+
+        entries = []
+        # tracks archived after the snapshot was written
+        skip = self.journal.base - snapshot.get("base", 0)
+
+        if skip < 0:
+            return False
+
+        for uri,user,props in snapshot.get("tracks", [])[skip:]:
+            if props:
+                props = sboxify_dictify.prime("track", uri, props)
+
+            entries.append(sboxify_entry(uri, user, props))
+
+        with self.lock:
+            if self.synced:
+                return False
+
+            self.entries = entries
+            self.build_positions()
+            self.warm.set()
+
+        log.info("serving {} tracks from snapshot until logged in".format(len(entries)))
+
+        return True
+
+    def save_snapshot(self):
+        with self.lock:
+            tracks = [[entry.uri, entry.user, entry.props] for entry in self.entries]
+
+        snapshot_dump({"index": self.index, "base": self.journal.base, "tracks": tracks}, self.snapshot_path)
+        log.debug("saved snapshot of {} tracks".format(len(tracks)))
+
     def load_user_tracks(self):
-        if not os.path.exists(self.config.user_list):
-            self.users = []
-        else:
-            self.users = yaml.load(open(self.config.user_list))
+        saved = [list(track) for track in self.journal.tracks]
+        uris = [track.link.uri for track in self.playlist.tracks]
+        leftover = self.archive_leftover(saved, uris)
+
+        with self.lock:
+            self.entries = self.reconcile(saved, uris[leftover:])
+
+            if self.index and self.index >= len(self.entries):
+                log.warning("configured index ({}) is greater ".format(self.index) +
+                            "than playlist len ({}); resetting...".format(len(self.entries)))
+                self.index = 0
+                self.save_index()
+
+            self.build_positions()
+            self.synced = True
+
+            if leftover:
+                log.info("removing {} archived tracks left in the playlist".format(leftover))
+                self.inflight += 1
+                self.commands.submit(session_queue.PLAYLIST, "playlist archive",
+                                     self.spotify_remove, list(range(leftover)))
+
+            if [[entry.uri, entry.user] for entry in self.entries] != saved:
+                self.journal.reset([[entry.uri, entry.user] for entry in self.entries])
+
+            # clients that read the snapshot have to reload
+            if self.warm.is_set():
+                self.changed("reset")
+
+    def archive_leftover(self, saved, uris):
+        # tracks archived to the journal and history right before a crash
+        # can still be at the head of the spotify playlist
+        count = len(uris) - len(saved)
+
+        if count <= 0 or uris[count:] != [uri for uri,user in saved]:
+            return 0
+
+        archived = [record["uri"] for record in reversed(self.history.page(limit=count))]
+
+        return count if archived == uris[:count] else 0
+
+    def reconcile(self, saved, uris):
+        # keep users of saved tracks still in the playlist, in playlist order
+        if saved and len(saved) == len(uris) and all(uri is None for uri,user in saved):
+            log.info("upgrading user list with playlist uris")
+            return [sboxify_entry(uri, user) for uri,(saved_uri,user) in zip(uris, saved)]
+
+        entries = [sboxify_entry(uri, None) for uri in uris]
+        matcher = difflib.SequenceMatcher(None, [uri for uri,user in saved], uris, autojunk=False)
+        matched = 0
+        used = set()
+
+        for a,b,size in matcher.get_matching_blocks():
+            for i in range(size):
+                entries[b + i].user = saved[a + i][1]
+                used.add(a + i)
+
+            matched += size
+
+        # tracks moved out of order keep their users too
+        moved = {}
+
+        for idx,(uri,user) in enumerate(saved):
+            if idx not in used:
+                moved.setdefault(uri, []).append(user)
+
+        for entry in entries:
+            if entry.user is not None:
+                continue
+
+            users = moved.get(entry.uri)
+
+            if users:
+                entry.user = users.pop(0)
+                matched += 1
+            else:
+                entry.user = "unknown_user"
+
+        if matched != len(uris) or matched != len(saved):
+            log.warning("user tracks out of sync with playlist; kept {} of {} users ".format(matched, len(saved)) +
+                        "for {} playlist tracks".format(len(uris)))
+
+        return entries
+
+    def build_positions(self):
+        self.user_positions = {}
+        self.uri_positions = {}
+
+        for idx,entry in enumerate(self.entries):
+            self.user_positions.setdefault(entry.user, []).append(idx)
+            self.uri_positions.setdefault(entry.uri, []).append(idx)
+
+        self.queue.reset([entry.user for entry in self.entries[self.index + 1:]])
+
+    def shift_positions(self, position, delta):
+        # move every index entry at or after position by delta
+        for index in (self.user_positions, self.uri_positions):
+            for positions in index.values():
+                start = bisect.bisect_left(positions, position)
+
+                for i in range(start, len(positions)):
+                    positions[i] += delta
+
+    def insert_entry(self, position, entry):
+        # the current track moves along unless nothing has been played yet
+        shift = position <= self.index < len(self.entries)
+
+        if position < len(self.entries):
+            self.shift_positions(position, 1)
+
+        self.entries.insert(position, entry)
+        bisect.insort(self.user_positions.setdefault(entry.user, []), position)
+        bisect.insort(self.uri_positions.setdefault(entry.uri, []), position)
+
+        if shift:
+            self.index += 1
+        elif position > self.index:
+            self.queue.add(entry.user)
+
+    def remove_entry(self, position):
+        entry = self.entries.pop(position)
+
+        for index,key in ((self.user_positions, entry.user), (self.uri_positions, entry.uri)):
+            positions = index[key]
+            positions.remove(position)
+
+            if not positions:
+                del index[key]
+
+        self.shift_positions(position, -1)
+
+        if position > self.index:
+            self.queue.remove(entry.user)
+        elif position < self.index:
+            self.index -= 1
+        elif position < len(self.entries):
+            # the next upcoming track has become the current one
+            self.queue.remove(self.entries[position].user)
+
+        return entry
+
+    def run_updates(self):
+        while True:
+            item = self.updates.get()
+
+            if item is None:
+                break
+
+            func,args = item
+
+            try:
+                func(*args)
+            except Exception:
+                log.exception("failed to apply playlist update")
 
-        user_tracks_len = len(self.users)
-        playlist_len = len(self.playlist.tracks)
+    def on_tracks_added(self, playlist, tracks, index):
+        uris = [track.link.uri for track in tracks]
+        self.updates.put((self.tracks_added, (uris, index)))
 
-        if user_tracks_len != playlist_len:
-            log.warning("user_tracks mismatch, resetting... " +
-                        "(user_tracks={}, playlist={})".format(user_tracks_len, playlist_len))
-            self.users = ["unknown_user"] * playlist_len
-            yaml.dump(self.users, open(self.config.user_list, 'w'))
+    def on_tracks_removed(self, playlist, indexes):
+        self.updates.put((self.tracks_removed, (list(indexes),)))
+
+    def on_tracks_moved(self, playlist, indexes, new_index):
+        self.updates.put((self.tracks_moved, (list(indexes), new_index)))
+
+    def tracks_added(self, uris, index):
+        with self.lock:
+            if self.inflight or len(self.entries) == len(self.playlist.tracks):
+                return
+
+            if len(self.entries) + len(uris) != len(self.playlist.tracks):
+                return self.resync()
+
+            log.info("{} tracks added outside sbox at {}".format(len(uris), index))
+
+            for offset,uri in enumerate(uris):
+                entry = sboxify_entry(uri, "unknown_user")
+                self.insert_entry(index + offset, entry)
+                self.changed("add", position=index + offset, key=entry.uri)
+
+            self.journal.append_many([("insert", index + offset, "unknown_user", uri)
+                                      for offset,uri in enumerate(uris)])
+            self.save_index()
+
+    def tracks_removed(self, indexes):
+        with self.lock:
+            if self.inflight or len(self.entries) == len(self.playlist.tracks):
+                return
+
+            if len(self.entries) - len(indexes) != len(self.playlist.tracks):
+                return self.resync()
+
+            log.info("{} tracks removed outside sbox".format(len(indexes)))
+            removed = sorted(indexes, reverse=True)
+
+            for idx in removed:
+                entry = self.remove_entry(idx)
+                self.changed("remove", position=idx, key=entry.uri)
+
+            self.journal.append_many([("remove", idx) for idx in removed])
+            self.save_index()
+
+    def tracks_moved(self, indexes, new_index):
+        with self.lock:
+            if self.inflight:
+                return
+
+            log.info("{} tracks moved outside sbox".format(len(indexes)))
+            self.resync()
+
+    def resync(self):
+        uris = [track.link.uri for track in self.playlist.tracks]
+        saved = [[entry.uri, entry.user] for entry in self.entries]
+        current = self.entries[self.index] if self.index < len(self.entries) else None
+        self.entries = self.reconcile(saved, uris)
+
+        if current in self.entries:
+            self.index = self.entries.index(current)
+
+        self.index = min(self.index, max(len(self.entries) - 1, 0))
+        self.build_positions()
+        self.journal.reset([[entry.uri, entry.user] for entry in self.entries])
+        self.save_index()
+        self.changed("reset")
 
     def get_playlist(self):
         info = self.config.spotify_playlist
@@ -307,19 +1404,14 @@ class sboxify_playlist(object):
             return False
 
         self.playlist = self.session.get_playlist(config_uri)
-        spotify_name = self.playlist.load().name
+        with metrics.spotify_latency.time(op="load", type="playlist"):
+            spotify_name = self.playlist.load().name
         log.info("loaded playlist: {} ({})".format(config_name, config_uri))
 
         if not spotify_name == config_name:
             log.warning("configured playlist name ({}) does not match" + 
                         "spotify playlist name ({})".format(spotify, config_name))
 
-        if self.index >= len(self.playlist.tracks):
-            log.warning("configured index ({}) is greater".format(self.index) +
-                        "than playlist len ({}); resetting...".format(len(self.playlist.tracks)))
-            self.index = 0
-            self.config.spotify_index = self.index
-
         return True
 
     def create_playlist(self):
@@ -332,90 +1424,314 @@ class sboxify_playlist(object):
         self.config.spotify_playlist = info
         log.info("created new playlist: {} ({})".format(self.playlist.name, uri))
 
-    def get_tracks(self):
-        tracks = sboxify_dictify.tracks(self.playlist.tracks[self.index:])
+    def save_index(self):
+        # stored counting archived tracks too, so archiving never has to
+        # rewrite it and a stale value cannot point at the wrong track
+        self.config.spotify_index = self.journal.base + self.index
 
-        return tracks
+    def start_archive(self):
+        with self.lock:
+            if self.archiving or not self.synced or self.index - self.history_keep < self.history_batch:
+                return
 
-    def get_user_tracks(self, user_id):
-        out = []
-        tracks = self.playlist.tracks[self.index:]
+            self.archiving = True
 
-        for idx,user in enumerate(self.users[self.index:]):
-            if user != user_id:
-                continue
+        archiver = thread(None, self.archive, "archive")
+        archiver.daemon = True
+        archiver.start()
 
-            out.append(tracks[idx])
+    def archive(self):
+        try:
+            with self.lock:
+                count = self.index - self.history_keep
 
-        return sboxify_dictify.tracks(out)
+                if count < self.history_batch:
+                    return
+
+                now = time.time()
+                base = self.journal.base
+                self.history.append_many([{"position": base + idx,
+                                           "uri": entry.uri,
+                                           "user": entry.user,
+                                           "played": entry.played,
+                                           "archived": now,
+                                           "track": entry.props}
+                                          for idx,entry in enumerate(self.entries[:count])])
+
+                # mirror, journal and index move in one step under the lock
+                self.entries = self.entries[count:]
+                self.index -= count
+                self.build_positions()
+                self.journal.archive(count)
+                self.save_index()
+
+                self.inflight += 1
+                futures = [self.commands.submit(session_queue.PLAYLIST, "playlist archive",
+                                                self.spotify_remove, list(range(count)))]
+                self.changed("reset")
+
+            self.wait(futures, [])
+            metrics.playlist_archived.inc(count)
+            log.info("archived {} played tracks (base {})".format(count, base + count))
+        finally:
+            with self.lock:
+                self.archiving = False
 
-    def add_track(self, key, user_id):
-        users = []
-        offset = 0
+    def get_history(self, before=None, limit=50, deadline=None):
+        records = self.history.page(before, limit)
+        missing = [record for record in records if not record.get("track")]
 
-        while not users:
-            index = self.index + offset
+        if missing:
+            props = sboxify_dictify.tracks([spotify.Track(self.session, uri=record["uri"])
+                                            for record in missing], deadline)
 
-            for idx,user in enumerate(self.users[index:]):
-                if user in users:
-                    break
+            for record,track in zip(missing, props):
+                record["track"] = track
 
-                users.append(user)
+        return records
 
-            offset += idx
+    def track(self, entry):
+        return spotify.Track(self.session, uri=entry.uri)
 
-            if user_id not in users:
-                break
+    def props(self, entries, deadline=None):
+        missing = [entry for entry in entries if entry.props is None]
+        pending = {}
 
-            users = []
+        if missing:
+            props = sboxify_dictify.tracks([self.track(entry) for entry in missing], deadline)
 
-        log.debug("index: {}".format(offset))
+            for entry,track in zip(missing, props):
+                if track.get("pending"):
+                    pending[entry] = track
+                else:
+                    entry.props = track
 
-        track = spotify.Track(self.session, uri=key)
-        self.playlist.add_tracks(track)
-        self.add_user_track(user_id)
+        return [pending.get(entry, entry.props) for entry in entries]
 
-        return sboxify_dictify.track_props(track)
+    def get_length(self):
+        return max(len(self.entries) - self.index, 0)
 
-    def add_user_track(self, user_id):
-        self.users.append(user_id)
-        yaml.dump(self.users, open(self.config.user_list, 'w'))
+    def get_tracks(self, offset=0, limit=None):
+        start = self.index + max(offset, 0)
+        end = None if limit is None else start + limit
 
-    def remove_track(self, key, user_id):
-        for idx,track in enumerate(self.playlist.tracks):
-            if track.load().link.uri != key:
-                continue
+        return self.entries[start:end]
 
-            if self.users[idx] != user_id:
-                continue
+    def get_user_tracks(self, user_id, deadline=None):
+        with self.lock:
+            positions = self.user_positions.get(user_id, [])
+            start = bisect.bisect_left(positions, self.index)
+            out = [self.entries[idx] for idx in positions[start:]]
+
+        return self.props(out, deadline)
+
+    def add_track(self, key, user_id, deadline=None):
+        result = self.add_tracks([key], user_id, deadline)[0]
+
+        return result.get("track", result)
+
+    def add_tracks(self, keys, user_id, deadline=None):
+        results = []
+        tracks = []
+
+        for key in keys:
+            try:
+                tracks.append(spotify.Track(self.session, uri=key))
+                results.append({"key": key})
+            except ValueError as e:
+                log.warning("invalid track key {}: {}".format(key, e))
+                results.append({"key": key, "error": "invalid key"})
+
+        props = iter(sboxify_dictify.tracks(tracks, deadline))
+        added = [result for result in results if "error" not in result]
+
+        with self.lock:
+            for result in added:
+                result["track"] = next(props)
+
+                # upcoming tracks start after the one currently playing
+                position = self.index + 1 + self.queue.position(user_id)
+                position = min(position, len(self.entries))
+                log.debug("index: {}".format(position))
+
+                track = None if result["track"].get("pending") else result["track"]
+                self.insert_entry(position, sboxify_entry(result["key"], user_id, track))
+                result["position"] = position
+
+            # queued in mirror order; the session queue coalesces adds
+            self.inflight += len(added)
+            futures = [self.commands.submit_batch(session_queue.PLAYLIST, "playlist add",
+                                                  self.spotify_add, (track, result["position"]))
+                       for track,result in zip(tracks, added)]
+
+            self.add_user_tracks(added, user_id)
+            self.save_index()
+
+            for result in added:
+                self.changed("add", position=result["position"], key=result["key"], track=result["track"])
+
+        self.wait(futures, added)
+
+        return results
+
+    def spotify_add(self, items):
+        # consecutive inserts at adjacent positions go in one call
+        runs = []
+
+        for track,index in items:
+            if runs and runs[-1][1] + len(runs[-1][0]) == index:
+                runs[-1][0].append(track)
+            else:
+                runs.append(([track], index))
+
+        try:
+            for tracks,index in runs:
+                self.playlist.add_tracks(tracks, index=index)
+        finally:
+            with self.lock:
+                self.inflight -= len(items)
+
+        return [None] * len(items)
+
+    def spotify_remove(self, indexes):
+        try:
+            self.playlist.remove_tracks(indexes)
+        finally:
+            with self.lock:
+                self.inflight -= 1
+
+    def wait(self, futures, results):
+        try:
+            for f in futures:
+                f.result()
+        except Exception as e:
+            log.warning("playlist update failed in spotify: {}".format(e))
+
+            for result in results:
+                result["error"] = "spotify update failed"
+
+            with self.lock:
+                self.resync()
 
-            self.playlist.remove_tracks(idx)
-            self.remove_user_track(idx)
-            return sboxify_dictify.track_props(track)
+    def add_user_tracks(self, added, user_id):
+        self.journal.append_many([("insert", result["position"], user_id, result["key"])
+                                  for result in added])
 
-        return {"error": "track not found for user id"}
+    def remove_track(self, key, user_id, deadline=None):
+        result = self.remove_tracks([key], user_id, deadline)[0]
 
-    def remove_user_track(self, idx):
-        del self.users[idx]
-        yaml.dump(self.users, open(self.config.user_list, 'w'))
+        return result.get("track", result)
+
+    def remove_tracks(self, keys, user_id, deadline=None):
+        results = []
+        found = set()
+
+        with self.lock:
+            for key in keys:
+                for idx in self.uri_positions.get(key, []):
+                    if idx not in found and self.entries[idx].user == user_id:
+                        found.add(idx)
+                        results.append({"key": key, "position": idx})
+                        break
+                else:
+                    results.append({"key": key, "error": "track not found for user id"})
+
+            removed = sorted(found, reverse=True)
+
+            if not removed:
+                return results
+
+            self.inflight += 1
+            futures = [self.commands.submit(session_queue.PLAYLIST, "playlist remove",
+                                            self.spotify_remove, removed)]
+
+            entries = dict((idx, self.remove_entry(idx)) for idx in removed)
+            self.remove_user_tracks(removed)
+            self.save_index()
+
+            for idx in removed:
+                self.changed("remove", position=idx, key=entries[idx].uri)
+
+        self.wait(futures, [result for result in results if "error" not in result])
+        props = dict(zip(removed, self.props([entries[idx] for idx in removed], deadline)))
+
+        for result in results:
+            if "error" not in result:
+                result["track"] = props[result["position"]]
+
+        return results
+
+    def remove_user_tracks(self, positions):
+        self.journal.append_many([("remove", idx) for idx in positions])
+
+    def set_index(self, index):
+        with self.lock:
+            if index == self.index + 1:
+                self.queue.remove(self.entries[index].user)
+            elif index == self.index - 1:
+                self.queue.add(self.entries[self.index].user)
+            elif index != self.index:
+                self.queue.reset([entry.user for entry in self.entries[index + 1:]])
+
+            self.index = index
+            self.save_index()
+            self.changed("index", index=index)
+            entry = self.entries[self.index]
+            entry.played = time.time()
+
+        return sboxify_dictify.load(self.track(entry))
 
     def get_next_track(self):
-        self.index = (self.index + 1) % len(self.playlist.tracks)
-        self.config.spotify_index = self.index
-        return self.playlist.tracks[self.index].load()
+        if not self.entries:
+            return None
+
+        return self.set_index((self.index + 1) % len(self.entries))
+
+    def peek_next_track(self):
+        with self.lock:
+            if not self.entries:
+                return None
+
+            return self.track(self.entries[(self.index + 1) % len(self.entries)])
 
     def get_prev_track(self):
-        self.index = (self.index - 1) % len(self.playlist.tracks) 
-        self.config.spotify_index = self.index
-        return self.playlist.tracks[self.index].load()
+        if not self.entries:
+            return None
+
+        return self.set_index((self.index - 1) % len(self.entries))
+
+def sboxify_sink(session, sink):
+    if sink == "alsa":
+        return spotify.AlsaSink(session)
+
+    if sink == "portaudio":
+        return spotify.PortAudioSink(session)
+
+    if sink != "null":
+        log.warning("unknown spotify_sink '{}'; discarding audio".format(sink))
+
+    return sboxify_null_sink(session)
+
+class sboxify_null_sink(object):
+    def __init__(self, session):
+        self.session = session
+        session.on(spotify.SessionEvent.MUSIC_DELIVERY, self.on_music_delivery)
+
+    def on_music_delivery(self, session, audio_format, frames, num_frames):
+        # consume everything so playback keeps running at full speed
+        return num_frames
 
 class sboxify_player(object):
-    def __init__(self, session, playlist, config):
+    def __init__(self, session, playlist, config, events, commands):
         self.session = session
+        self.commands = commands
         self.playlist = playlist
-        self.audio = spotify.AlsaSink(session)
+        self.audio = sboxify_sink(session, config.get("spotify_sink", "alsa"))
         self.config = config
+        self.events = events
+        self.gaps = deque(maxlen=100)
 
+        playlist.listeners.append(self.on_playlist_changed)
         session.on(spotify.SessionEvent.END_OF_TRACK, self.on_end_of_track)
 
     def is_playing(self):
@@ -428,26 +1744,96 @@ class sboxify_player(object):
         return self.session.player.state == spotify.player.PlayerState.LOADED
 
     def play_track(self, track):
+        if track is None:
+            log.info("playlist is empty; nothing to play")
+            return
+
+        props = sboxify_dictify.track_props(track)
+
         try:
-            log.info("playing next track: {}, artist: {}, album: {}".format(track.name,
-                                                                            track.artists[0].load().name,
-                                                                            track.album.load().name))
+            log.info("playing next track: {}, artist: {}, album: {}".format(props["name"],
+                                                                            props["artists"][0][1],
+                                                                            props["album"][1]))
         except UnicodeEncodeError as e:
             log.error(e)
 
+        self.commands.call(session_queue.PLAYER, "player load", self.load_and_play, track)
+        self.changed("playing", track)
+        self.start_prefetch()
+
+    def load_and_play(self, track):
         self.session.player.load(track)
         self.session.player.play()
 
+    def start_prefetch(self):
+        prefetch = thread(None, self.prefetch, "prefetch")
+        prefetch.daemon = True
+        prefetch.start()
+
+    def prefetch(self):
+        track = self.playlist.peek_next_track()
+
+        if track is None:
+            return
+
+        # resolves the track with its album and artists for play_track
+        sboxify_dictify.track_props(track)
+
+        if hasattr(self.session.player, "prefetch"):
+            self.commands.call(session_queue.PLAYER, "player prefetch", self.session.player.prefetch, track)
+
+        log.debug("prefetched next track: {}".format(track.link.uri))
+
+    def on_playlist_changed(self, change):
+        if change["op"] == "reset":
+            self.start_prefetch()
+        elif change["op"] in ("add", "remove") and change["position"] <= self.playlist.index + 1:
+            self.start_prefetch()
+
     def play_next(self):
         track = self.playlist.get_next_track()
         self.play_track(track)
+        self.playlist.start_archive()
 
     def play_prev(self):
         track = self.playlist.get_prev_track()
         self.play_track(track)
 
     def on_end_of_track(self, session):
+        # runs on the reactor thread, which must not wait on the session queue
+        advance = thread(None, self.end_of_track, "end of track")
+        advance.daemon = True
+        advance.start()
+
+    def end_of_track(self):
+        start = time.time()
         self.play_next()
+        gap = time.time() - start
+        self.gaps.append(gap)
+        metrics.transition_gap.observe(gap)
+        log.debug("track transition took {:.1f} ms".format(gap * 1000))
+
+    def status(self):
+        gaps = list(self.gaps)
+        state = "stopped"
+
+        if self.is_playing():
+            state = "playing"
+        elif self.is_paused():
+            state = "paused"
+
+        out = {
+                "state": state,
+                "index": self.playlist.index,
+                "gap": {"count": len(gaps)},
+              }
+
+        if gaps:
+            out["gap"]["last"] = gaps[-1]
+            out["gap"]["avg"] = sum(gaps) / len(gaps)
+            out["gap"]["max"] = max(gaps)
+
+        return out
 
     def handle_logged_in(self):
         self.play_next()
@@ -460,9 +1846,19 @@ class sboxify_player(object):
 
     def play(self):
         if self.is_paused():
-            self.session.player.play()
+            self.commands.call(session_queue.PLAYER, "player play", self.session.player.play)
+            self.changed("playing")
         elif not self.is_loaded():
             self.play_next()
 
     def pause(self):
-        self.session.player.pause()
+        self.commands.call(session_queue.PLAYER, "player pause", self.session.player.pause)
+        self.changed("paused")
+
+    def changed(self, state, track=None):
+        change = {"state": state, "index": self.playlist.index}
+
+        if track:
+            change["key"] = track.link.uri
+
+        self.events.publish("player", change)
@@ -0,0 +1,444 @@
+#!/usr/bin/env python2
+
+from threading import Thread as thread
+from threading import RLock as lock
+from werkzeug.serving import BaseWSGIServer
+from werkzeug.serving import WSGIRequestHandler
+from reactor import reactor
+import logging
+import socket
+import errno
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+class keepalive_handler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    detached = False
+    parked = False
+
+    def handle_one_request(self):
+        WSGIRequestHandler.handle_one_request(self)
+
+        # an idle keep-alive connection waits for its next request in the
+        # reactor, not in a pool worker
+        if not self.close_connection and self.server.reactor is not None:
+            self.parked = True
+            self.close_connection = True
+
+    def resume(self):
+        self.parked = False
+
+        try:
+            self.handle()
+        finally:
+            self.finish()
+
+    def pending(self):
+        # pipelined requests already buffered would never wake the reactor
+        buffered = getattr(self.rfile, "_rbuf", None)
+
+        if buffered is not None:
+            return buffered.tell() > 0
+
+        self.connection.settimeout(0)
+
+        try:
+            return bool(self.rfile.peek(1))
+        except (socket.error, ValueError):
+            return True
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def run_wsgi(self):
+        if self.path.split("?")[0] not in self.server.streams:
+            return WSGIRequestHandler.run_wsgi(self)
+
+        # long-lived streams must not hold on to a pool worker
+        self.close_connection = True
+        self.detached = self.server.detach(self)
+
+    def finish(self):
+        if self.detached:
+            return
+
+        if self.parked:
+            self.wfile.flush()
+            self.server.parking[self.request] = self
+            return
+
+        WSGIRequestHandler.finish(self)
+
+class stream(object):
+    __slots__ = ("handler", "body", "q", "out", "sent", "retry")
+
+    def __init__(self, handler, body, q):
+        self.handler = handler
+        self.body = body
+        self.q = q
+        self.out = b""
+        self.sent = time.time()
+        self.retry = None
+
+# Every event stream is written from this one thread: an idle listener
+# costs a socket and a small buffer instead of a thread and its stack.
+class stream_pump(object):
+    def __init__(self, server, heartbeat=15, max_buffer=64 * 1024):
+        self.server = server
+        self.heartbeat = heartbeat
+        self.max_buffer = max_buffer
+        self.reactor = reactor()
+        self.streams = {}
+        self.thread = thread(None, self.reactor.run, "http streams")
+        self.thread.daemon = True
+        self.thread.start()
+        self.reactor.call_later(heartbeat, self.beat)
+
+    def add(self, handler, body, q):
+        self.reactor.call_soon(self.open, stream(handler, body, q))
+
+    def notify(self, request):
+        # called by the event hub from whichever thread published
+        self.reactor.call_soon(self.drain, request)
+
+    def open(self, s):
+        request = s.handler.request
+        self.streams[request] = s
+        self.reactor.add_reader(request, lambda: self.readable(request))
+        self.pull(s)
+
+    def pull(self, s):
+        # only this thread reads the queue, so next() never waits
+        while True:
+            try:
+                s.out += next(s.body)
+            except StopIteration:
+                return self.close(s)
+
+            if s.q.empty():
+                break
+
+        self.flush(s)
+
+    def drain(self, request):
+        s = self.streams.get(request)
+
+        if s is not None and not s.q.empty():
+            self.pull(s)
+
+    def flush(self, s):
+        self.reactor.cancel(s.retry)
+        s.retry = None
+
+        try:
+            sent = s.handler.request.send(s.out) if s.out else 0
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return self.close(s)
+
+            sent = 0
+
+        if sent:
+            s.out = s.out[sent:]
+            s.sent = time.time()
+
+        if len(s.out) > self.max_buffer:
+            log.warning("dropping stalled event stream {}".format(s.handler.client_address))
+            return self.close(s)
+
+        if s.out:
+            s.retry = self.reactor.call_later(.1, self.flush, s)
+
+    def readable(self, request):
+        s = self.streams.get(request)
+
+        if s is None:
+            return
+
+        try:
+            data = request.recv(4096)
+        except socket.error as e:
+            data = b"" if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK) else None
+
+        # clients never send anything after the request, so this is a hang up
+        if data == b"":
+            self.close(s)
+
+    def beat(self):
+        now = time.time()
+
+        for s in list(self.streams.values()):
+            if now - s.sent >= self.heartbeat and not s.out:
+                s.out = b": keepalive\n\n"
+                self.flush(s)
+
+        self.reactor.call_later(self.heartbeat, self.beat)
+
+    def close(self, s):
+        request = s.handler.request
+
+        if self.streams.pop(request, None) is None:
+            return
+
+        self.reactor.remove_reader(request)
+        self.reactor.cancel(s.retry)
+
+        try:
+            if hasattr(s.body, "close"):
+                s.body.close()
+        except Exception:
+            log.exception("closing event stream failed")
+
+        self.server.release(s.handler)
+
+    def stop(self):
+        def close_all():
+            for s in list(self.streams.values()):
+                self.close(s)
+
+        self.reactor.call_sync(close_all)
+        self.reactor.stop()
+        self.thread.join()
+
+class pooled_server(BaseWSGIServer):
+    def __init__(self, host, port, app, threads=8, queue_size=64, timeout=30, shutdown_timeout=5,
+                 streams=(), heartbeat=15):
+        self.request_queue_size = queue_size
+        self.shutdown_timeout = shutdown_timeout
+        self.streams = set(streams)
+        self.detached = set()
+        self.lock = lock()
+        # handlers a worker is about to park, and those waiting in the reactor
+        self.parking = {}
+        self.parked = {}
+        self.idle_timeout = timeout
+        self.requests = queue.Queue(queue_size)
+        handler = type("handler", (keepalive_handler,), {"timeout": timeout})
+        BaseWSGIServer.__init__(self, host, port, app, handler)
+        self.reactor = None
+        self.pump = stream_pump(self, heartbeat)
+        self.workers = []
+
+        for i in range(threads):
+            worker = thread(None, self.work, "http worker {}".format(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def attach(self, reactor):
+        # accept connections from the shared reactor instead of
+        # polling in serve_forever
+        self.reactor = reactor
+        reactor.add_reader(self.socket, self._handle_request_noblock)
+
+    def process_request(self, request, client_address):
+        self.queue(request, client_address)
+
+    def queue(self, request, client_address, handler=None):
+        try:
+            self.requests.put_nowait((request, client_address, handler))
+        except queue.Full:
+            log.warning("request queue full; dropping {}".format(client_address))
+            self.close(request, handler)
+
+    def work(self):
+        while True:
+            item = self.requests.get()
+
+            if item is None:
+                break
+
+            request,client_address,handler = item
+
+            try:
+                if handler is None:
+                    self.finish_request(request, client_address)
+                else:
+                    handler.resume()
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                handler = self.parking.pop(request, None)
+
+                if handler is not None:
+                    self.park(handler)
+                elif request not in self.detached:
+                    self.shutdown_request(request)
+
+    def park(self, handler):
+        request = handler.request
+
+        if handler.pending():
+            return self.queue(request, handler.client_address, handler)
+
+        with self.lock:
+            timer = self.reactor.call_later(self.idle_timeout, self.expire, request)
+            self.parked[request] = (handler, timer)
+
+        self.reactor.add_reader(request, lambda: self.unpark(request))
+
+    def unpark(self, request):
+        # on the reactor thread: the next request has started to arrive
+        with self.lock:
+            item = self.parked.pop(request, None)
+
+        if item is None:
+            return
+
+        handler,timer = item
+        self.reactor.remove_reader(request)
+        self.reactor.cancel(timer)
+        self.queue(request, handler.client_address, handler)
+
+    def expire(self, request):
+        with self.lock:
+            item = self.parked.pop(request, None)
+
+        if item is not None:
+            self.reactor.remove_reader(request)
+            self.close(request, item[0])
+
+    def close(self, request, handler=None):
+        if handler is not None:
+            handler.parked = False
+            handler.finish()
+
+        self.shutdown_request(request)
+
+    def detach(self, handler):
+        # runs the app in the worker, then leaves the body to the pump;
+        # returns whether the connection was handed over
+        request = handler.request
+        environ = handler.make_environ()
+        environ["sbox.stream.notify"] = lambda: self.pump.notify(request)
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        body = iter(self.app(environ, start_response))
+        q = environ.get("sbox.stream")
+
+        if q is None:
+            # refused, so answered like any other request
+            try:
+                data = b"".join(body)
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+
+            self.send_head(handler, response, len(data))
+            handler.wfile.write(data)
+
+            return False
+
+        self.send_head(handler, response)
+        handler.wfile.flush()
+        request.setblocking(False)
+        self.detached.add(request)
+        self.pump.add(handler, body, q)
+
+        return True
+
+    def send_head(self, handler, response, length=None):
+        status,headers = response
+        code,sep,message = status.partition(" ")
+        handler.send_response(int(code), message)
+
+        for key,value in headers:
+            if key.lower() not in ("connection", "content-length", "transfer-encoding"):
+                handler.send_header(key, value)
+
+        if length is not None:
+            handler.send_header("Content-Length", str(length))
+
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+
+    def release(self, handler):
+        handler.request.setblocking(True)
+        WSGIRequestHandler.finish(handler)
+        self.detached.discard(handler.request)
+        self.shutdown_request(handler.request)
+
+    def stop(self):
+        if self.reactor:
+            self.reactor.remove_reader(self.socket)
+        else:
+            self.shutdown()
+
+        with self.lock:
+            parked,self.parked = list(self.parked.items()),{}
+
+        for request,(handler,timer) in parked:
+            self.reactor.remove_reader(request)
+            self.reactor.cancel(timer)
+            self.close(request, handler)
+
+        deadline = time.time() + self.shutdown_timeout
+
+        for worker in self.workers:
+            self.requests.put(None)
+
+        for worker in self.workers:
+            worker.join(max(deadline - time.time(), 0))
+
+        self.pump.stop()
+
+class cheroot_server(object):
+    # cheroot serves streams from its worker pool, so listeners may only
+    # take half of it
+    def __init__(self, host, port, app, threads=8, queue_size=64, timeout=30, shutdown_timeout=5,
+                 streams=(), heartbeat=15):
+        from cheroot import wsgi
+
+        self.max_streams = threads // 2
+
+        self.server = wsgi.Server((host, port), app,
+                                  numthreads=threads,
+                                  request_queue_size=queue_size,
+                                  timeout=timeout,
+                                  shutdown_timeout=shutdown_timeout)
+
+    def serve_forever(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+backends = {
+            "werkzeug": pooled_server,
+            "cheroot": cheroot_server,
+           }
+
+def make_server(config, app, streams=()):
+    name = config.get("http_server", "werkzeug")
+    backend = backends.get(name)
+
+    if backend is None:
+        log.warning("unknown http_server '{}'; using werkzeug".format(name))
+        backend = pooled_server
+
+    args = (config.http_host, config.http_port, app,
+            config.get("http_threads", 8),
+            config.get("http_queue", 64),
+            config.get("http_timeout", 30),
+            config.get("http_shutdown_timeout", 5))
+    heartbeat = config.get("events_heartbeat", 15)
+
+    try:
+        server = backend(*args, streams=streams, heartbeat=heartbeat)
+    except ImportError as e:
+        log.warning("http_server '{}' not available ({}); using werkzeug".format(name, e))
+        server = pooled_server(*args, streams=streams, heartbeat=heartbeat)
+
+    log.info("serving http on {}:{} with {}".format(config.http_host, config.http_port,
+                                                    type(server).__name__))
+
+    return server
@@ -2,15 +2,27 @@
 
 import os
 import sys
+import time
 import flask
+import hashlib
 import logging
+import metrics
+import encode
 from functools import wraps
+from server import make_server
+from limits import rate_limiter
+from limits import admission
 from threading import Thread as thread
-from flask.ext.restful import reqparse
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+default_rate_limits = {
+                       "search": {"rate": 2, "burst": 10},
+                       "browse": {"rate": 5, "burst": 20},
+                       "playlist": {"rate": 1, "burst": 10},
+                      }
+
 def check_spotify(func):
     @wraps(func)
     def wrapper(**kwargs):
@@ -24,6 +36,52 @@ def check_spotify(func):
 
     return wrapper
 
+def check_readable(func):
+    @wraps(func)
+    def wrapper(**kwargs):
+        if not __s.spotify:
+            return "spotify not available",503
+
+        if not __s.spotify.is_readable():
+            return "spotify not logged in",503
+
+        return func(**kwargs)
+
+    return wrapper
+
+def limited(route):
+    # per user and per address budgets, then a cap on concurrent spotify work
+    def decorator(func):
+        @wraps(func)
+        def wrapper(**kwargs):
+            args = flask.request.get_json(silent=True)
+
+            if not args:
+                args = flask.request.values.to_dict()
+
+            retry = __s.limits.check(route, args.get("id"), flask.request.remote_addr)
+
+            if retry:
+                return rejected("rate limited", retry)
+
+            if not __s.admission.acquire():
+                return rejected("busy", 1)
+
+            try:
+                return func(**kwargs)
+            finally:
+                __s.admission.release()
+
+        return wrapper
+
+    return decorator
+
+def rejected(reason, retry):
+    metrics.http_rejected.inc(endpoint=request_endpoint(), reason=reason)
+    log.debug("rejected {} request: {}".format(request_endpoint(), reason))
+
+    return "too many requests ({})".format(reason),429,{"Retry-After": str(retry)}
+
 class __service_class(object):
     def __init__(self):
         self.app = flask.Flask(__name__)
@@ -33,26 +91,58 @@ class __service_class(object):
 
     def set_config(self, config):
         self.config = config
+        self.limits = rate_limiter(config.get("rate_limits", default_rate_limits))
+        # requests only wait on spotify inside http workers, so the cap must
+        # leave some of them free or it never sheds anything
+        threads = config.get("http_threads", 8)
+        max_inflight = config.get("spotify_max_inflight", max(threads - 2, 1))
+
+        if max_inflight and max_inflight >= threads:
+            log.warning("spotify_max_inflight ({}) is not below http_threads ({}); ".format(max_inflight, threads) +
+                        "requests will queue instead of being shed")
+
+        self.admission = admission(max_inflight)
 
     def start(self):
-        self.thread = thread(None, self.run, "service thread")
-        self.thread.start()
+        self.server = make_server(self.config, self.app, streams=("/events",))
+        self.thread = None
+
+        # servers writing streams from their own workers can only spare a few
+        max_streams = getattr(self.server, "max_streams", None)
+
+        if max_streams is not None:
+            events = self.spotify.events
+            events.max_subscribers = min(events.max_subscribers, max_streams)
+            log.info("limiting event listeners to {}".format(events.max_subscribers))
+
+        if hasattr(self.server, "attach"):
+            self.server.attach(self.spotify.reactor)
+        else:
+            self.thread = thread(None, self.run, "service thread")
+            self.thread.start()
+
         log.debug("started")
 
     def stop(self):
-        self.thread._Thread__stop()
+        self.spotify.events.close()
+        self.server.stop()
+
+        if self.thread:
+            self.thread.join()
+
         log.debug("stopped")
 
     def run(self):
-        host = self.config.http_host
-        port = self.config.http_port
-
-        self.app.run(host=host, port=port)
+        self.server.serve_forever()
         log.debug("done")
 
     def get_user_admins(self):
         return self.config.user_admins
 
+    def get_compression(self):
+        return (self.config.get("http_compress_level", 6),
+                self.config.get("http_compress_min_size", 1024))
+
 __s = __service_class()
 
 def service(config, spotify):
@@ -60,6 +150,84 @@ def service(config, spotify):
     __s.set_spotify(spotify)
     return __s
 
+def make_etag(tag):
+    if tag is None:
+        return None
+
+    return hashlib.sha1(tag.encode("utf-8")).hexdigest()
+
+def not_modified(etag):
+    # checked before the request touches libspotify
+    if etag is None or flask.request.method != "GET":
+        return None
+
+    if not flask.request.if_none_match.contains_weak(etag):
+        return None
+
+    response = flask.Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "no-cache"
+
+    return response
+
+def json_response(data, etag=None):
+    # assembled from cached fragments, compressed when the client allows it
+    level,min_size = __s.get_compression()
+    encoding = None
+
+    if level:
+        encoding = flask.request.accept_encodings.best_match(encode.encodings)
+
+    body,encoding = encode.encode_response(data, encoding, level, min_size)
+    response = flask.Response(body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+
+    # partial and failed results must not be revalidated as complete
+    if etag and "error" not in data and not data.get("pending"):
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+
+    return response
+
+def request_endpoint():
+    return flask.request.endpoint or "unknown"
+
+@__s.app.before_request
+def before_request():
+    flask.g.start = time.time()
+    metrics.http_inflight.inc(endpoint=request_endpoint())
+
+@__s.app.after_request
+def after_request(response):
+    endpoint = request_endpoint()
+    metrics.http_requests.inc(endpoint=endpoint,
+                              method=flask.request.method,
+                              status=response.status_code)
+
+    if __s.spotify and response.status_code < 400 and endpoint != "metrics_get":
+        __s.spotify.startup("first_response")
+
+    return response
+
+@__s.app.teardown_request
+def teardown_request(exception):
+    endpoint = request_endpoint()
+    metrics.http_inflight.dec(endpoint=endpoint)
+    metrics.http_latency.observe(time.time() - flask.g.start, endpoint=endpoint)
+
+@__s.app.route("/metrics", methods=["GET"])
+def metrics_get():
+    if __s.spotify:
+        for stats in __s.spotify.caches():
+            metrics.cache_entries.set(stats["size"], cache=stats["name"])
+            metrics.cache_hits.set(stats["hits"], cache=stats["name"])
+            metrics.cache_misses.set(stats["misses"], cache=stats["name"])
+
+    return flask.Response(metrics.default.render(), mimetype="text/plain; version=0.0.4")
+
 @__s.app.route("/")
 @check_spotify
 def index():
@@ -69,95 +237,213 @@ def index():
 
 @__s.app.route("/search", methods=["POST", "GET"])
 @check_spotify
+@limited("search")
 def search():
     log.debug("search request: data '{}', values: {}".format(flask.request.data,
                                                              flask.request.values.to_dict()))
-    args = flask.request.get_json()
+    args = flask.request.get_json(silent=True)
 
     if not args:
         args = flask.request.values.to_dict()
 
+    etag = make_etag(__s.spotify.search_etag(args))
+    cached = not_modified(etag)
+
+    if cached:
+        return cached
+
     s = __s.spotify.search(args)
 
-    return flask.jsonify(s)
+    return json_response(s, etag or make_etag(__s.spotify.search_etag(args)))
 
 @__s.app.route("/playlist/add", methods=["POST", "GET"])
 @check_spotify
+@limited("playlist")
 def add():
     log.debug("add request: data '{}', values: {}".format(flask.request.data,
                                                           flask.request.values.to_dict()))
-    args = flask.request.get_json()
+    args = flask.request.get_json(silent=True)
 
     if not args:
         args = flask.request.values.to_dict()
 
     a = __s.spotify.playlist_add(args)
 
-    return flask.jsonify(a)
+    return json_response(a)
 
 @__s.app.route("/playlist/remove", methods=["POST", "GET"])
 @check_spotify
+@limited("playlist")
 def remove():
     log.debug("remove request: data '{}', values: {}".format(flask.request.data,
                                                              flask.request.values.to_dict()))
-    args = flask.request.get_json()
+    args = flask.request.get_json(silent=True)
 
     if not args:
         args = flask.request.values.to_dict()
 
     a = __s.spotify.playlist_remove(args)
 
-    return flask.jsonify(a)
+    return json_response(a)
 
-@__s.app.route("/playlist", methods=["POST", "GET"])
+@__s.app.route("/playlist/add/batch", methods=["POST", "GET"])
+@check_spotify
+@limited("playlist")
+def add_batch():
+    log.debug("add batch request: data '{}', values: {}".format(flask.request.data,
+                                                                flask.request.values.to_dict()))
+    args = flask.request.get_json(silent=True)
+
+    if not args:
+        args = flask.request.values.to_dict()
+
+    a = __s.spotify.playlist_add_batch(args)
+
+    return json_response(a)
+
+@__s.app.route("/playlist/remove/batch", methods=["POST", "GET"])
 @check_spotify
+@limited("playlist")
+def remove_batch():
+    log.debug("remove batch request: data '{}', values: {}".format(flask.request.data,
+                                                                   flask.request.values.to_dict()))
+    args = flask.request.get_json(silent=True)
+
+    if not args:
+        args = flask.request.values.to_dict()
+
+    a = __s.spotify.playlist_remove_batch(args)
+
+    return json_response(a)
+
+@__s.app.route("/playlist", methods=["POST", "GET"])
+@check_readable
 def playlist():
     log.debug("artist request: data '{}', values: {}".format(flask.request.data,
                                                              flask.request.values.to_dict()))
-    args = flask.request.get_json()
+    args = flask.request.get_json(silent=True)
 
     if not args:
         args = flask.request.values.to_dict()
 
     log.debug("playlist request")
+    etag = make_etag(__s.spotify.playlist_etag(args))
+    cached = not_modified(etag)
+
+    if cached:
+        return cached
+
     p = __s.spotify.playlist_get(args)
 
-    return flask.jsonify(p)
+    return json_response(p, etag)
+
+@__s.app.route("/history", methods=["POST", "GET"])
+@check_spotify
+def history():
+    log.debug("history request: data '{}', values: {}".format(flask.request.data,
+                                                              flask.request.values.to_dict()))
+    args = flask.request.get_json(silent=True)
+
+    if not args:
+        args = flask.request.values.to_dict()
+
+    h = __s.spotify.history_get(args)
+
+    return json_response(h)
+
+@__s.app.route("/events", methods=["GET"])
+@check_spotify
+def events():
+    log.debug("events request: values: {}".format(flask.request.values.to_dict()))
+    environ = flask.request.environ
+    q = __s.spotify.events.subscribe(environ.get("sbox.stream.notify"))
+
+    if q is None:
+        return "too many event listeners",503
+
+    # lets a server that fans streams out itself read the queue directly
+    environ["sbox.stream"] = q
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    return flask.Response(__s.spotify.events.stream(q), mimetype="text/event-stream", headers=headers)
+
+@__s.app.route("/player", methods=["POST", "GET"])
+@check_spotify
+def player():
+    log.debug("player request: data '{}', values: {}".format(flask.request.data,
+                                                             flask.request.values.to_dict()))
+    args = flask.request.get_json(silent=True)
+
+    if not args:
+        args = flask.request.values.to_dict()
+
+    p = __s.spotify.player_get(args)
+
+    return json_response(p)
+
+@__s.app.route("/image/<image_id>", methods=["GET"])
+@check_spotify
+@limited("image")
+def image(image_id):
+    log.debug("image request: id '{}', values: {}".format(image_id, flask.request.values.to_dict()))
+    data = __s.spotify.image_get(image_id, flask.request.values.to_dict())
+
+    if data is None:
+        return "image not available",404
+
+    headers = {"Cache-Control": "public, max-age=31536000"}
+
+    return flask.Response(data, mimetype="image/jpeg", headers=headers)
 
 @__s.app.route("/artist", methods=["POST", "GET"])
 @check_spotify
+@limited("browse")
 def artist():
     log.debug("artist request: data '{}', values: {}".format(flask.request.data,
                                                              flask.request.values.to_dict()))
-    args = flask.request.get_json()
+    args = flask.request.get_json(silent=True)
 
     if not args:
         args = flask.request.values.to_dict()
 
+    etag = make_etag(__s.spotify.browse_etag("artist", args))
+    cached = not_modified(etag)
+
+    if cached:
+        return cached
+
     a = __s.spotify.artist_get(args)
 
-    return flask.jsonify(a)
+    return json_response(a, etag)
 
 @__s.app.route("/album", methods=["POST", "GET"])
 @check_spotify
+@limited("browse")
 def album():
     log.debug("album request: data '{}', values: {}".format(flask.request.data,
                                                             flask.request.values.to_dict()))
-    args = flask.request.get_json()
+    args = flask.request.get_json(silent=True)
 
     if not args:
         args = flask.request.values.to_dict()
 
+    etag = make_etag(__s.spotify.browse_etag("album", args))
+    cached = not_modified(etag)
+
+    if cached:
+        return cached
+
     a = __s.spotify.album_get(args)
 
-    return flask.jsonify(a)
+    return json_response(a, etag)
 
 @__s.app.route("/login", methods=["POST", "GET"])
 @check_spotify
 def login():
     log.debug("login request: data '{}', values: {}".format(flask.request.data,
                                                             flask.request.values.to_dict()))
-    args = flask.request.get_json()
+    args = flask.request.get_json(silent=True)
     noadmin = flask.jsonify({"admin": False})
 
     if not args:
@@ -181,7 +467,7 @@ def control(action):
     log.debug("control request: action '{}', data '{}', values: {}".format(action,
                                                                            flask.request.data,
                                                                            flask.request.values.to_dict()))
-    args = flask.request.get_json()
+    args = flask.request.get_json(silent=True)
     noadmin = flask.jsonify({"admin": False})
 
     if not args:
@@ -197,4 +483,28 @@ def control(action):
 
     a = __s.spotify.control(action, args)
 
-    return flask.jsonify(a)
+    return json_response(a)
+
+@__s.app.route("/cache/<action>", methods=["POST", "GET"])
+@check_spotify
+def cache(action):
+    log.debug("cache request: action '{}', data '{}', values: {}".format(action,
+                                                                         flask.request.data,
+                                                                         flask.request.values.to_dict()))
+    args = flask.request.get_json(silent=True)
+    noadmin = flask.jsonify({"admin": False})
+
+    if not args:
+        args = flask.request.values.to_dict()
+
+    if "id" not in args:
+        log.warning("id missing in cache request")
+        return noadmin
+
+    if args["id"] not in __s.get_user_admins():
+        log.debug("id not admin: {}".format(args["id"]))
+        return noadmin
+
+    a = __s.spotify.cache(action, args)
+
+    return json_response(a)
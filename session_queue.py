@@ -0,0 +1,178 @@
+#!/usr/bin/env python2
+
+from threading import Thread as thread
+from threading import Condition as condition
+from threading import Event as event
+from threading import current_thread
+import logging
+import metrics
+import heapq
+import time
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# lower runs first
+PLAYER = 0
+PLAYLIST = 1
+BROWSE = 2
+SEARCH = 3
+IMAGE = 4
+WARM = 5
+
+class command_timeout(RuntimeError):
+    pass
+
+class future(object):
+    def __init__(self):
+        self.done = event()
+        self.value = None
+        self.error = None
+
+    def set_result(self, value):
+        self.value = value
+        self.done.set()
+
+    def set_exception(self, error):
+        self.error = error
+        self.done.set()
+
+    def result(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise command_timeout("command not done within {}s".format(timeout))
+
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+class command(object):
+    __slots__ = ("priority", "seq", "name", "func", "args", "key", "future", "queued")
+
+    def __init__(self, priority, seq, name, func, args, key):
+        self.priority = priority
+        self.seq = seq
+        self.name = name
+        self.func = func
+        self.args = args
+        self.key = key
+        self.future = future()
+        self.queued = time.time()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+# All calls into the spotify session go through this one worker, so they
+# never race each other and their throughput can be measured.
+class command_queue(object):
+    def __init__(self, max_batch=100):
+        self.max_batch = max_batch
+        self.cond = condition()
+        self.heap = []
+        self.seq = 0
+        self.stopping = False
+        self.thread = None
+
+    def submit(self, priority, name, func, *args):
+        return self.push(priority, name, func, args, None)
+
+    def submit_batch(self, priority, name, func, item):
+        # queued commands with the same name are handed to func together
+        # as a list of items; func returns one result per item
+        return self.push(priority, name, func, (item,), name)
+
+    def push(self, priority, name, func, args, key):
+        with self.cond:
+            # commands issued from the worker itself (from session
+            # callbacks) would wait on themselves, so they run right away,
+            # as does everything once the queue is stopped
+            if self.thread is not None and not self.stopping and current_thread() is not self.thread:
+                self.seq += 1
+                cmd = command(priority, self.seq, name, func, args, key)
+                heapq.heappush(self.heap, cmd)
+                metrics.spotify_queued.set(len(self.heap))
+                self.cond.notify()
+
+                return cmd.future
+
+        out = future()
+
+        try:
+            out.set_result(func([args[0]])[0] if key else func(*args))
+        except Exception as e:
+            out.set_exception(e)
+
+        return out
+
+    def call(self, priority, name, func, *args):
+        return self.submit(priority, name, func, *args).result()
+
+    def take(self):
+        with self.cond:
+            while not self.heap and not self.stopping:
+                self.cond.wait()
+
+            if not self.heap:
+                return None
+
+            batch = [heapq.heappop(self.heap)]
+
+            while (batch[0].key and self.heap and self.heap[0].key == batch[0].key and
+                   len(batch) < self.max_batch):
+                batch.append(heapq.heappop(self.heap))
+
+            metrics.spotify_queued.set(len(self.heap))
+
+        return batch
+
+    def execute(self, batch):
+        head = batch[0]
+        start = time.time()
+
+        for cmd in batch:
+            metrics.spotify_queue_latency.observe(start - cmd.queued, op=cmd.name)
+
+        try:
+            if head.key:
+                values = head.func([cmd.args[0] for cmd in batch])
+            else:
+                values = [head.func(*head.args)]
+        except Exception as e:
+            log.warning("{} failed: {}".format(head.name, e))
+
+            for cmd in batch:
+                cmd.future.set_exception(e)
+
+            return
+
+        metrics.spotify_commands.inc(len(batch), op=head.name)
+
+        if len(batch) > 1:
+            log.debug("coalesced {} {} commands".format(len(batch), head.name))
+
+        for cmd,value in zip(batch, values):
+            cmd.future.set_result(value)
+
+    def run(self):
+        while True:
+            batch = self.take()
+
+            if batch is None:
+                break
+
+            self.execute(batch)
+
+    def start(self):
+        self.thread = thread(None, self.run, "spotify commands")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # commands already queued are still run
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,386 @@
+#!/usr/bin/env python2
+
+from threading import Thread as thread
+from threading import Event as event
+from threading import RLock as lock
+from array import array
+import logging
+import json
+import yaml
+import os
+
+try:
+    from yaml import CSafeLoader as yaml_loader
+    from yaml import CSafeDumper as yaml_dumper
+except ImportError:
+    from yaml import SafeLoader as yaml_loader
+    from yaml import SafeDumper as yaml_dumper
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# files dumped by python 2 versions tag unicode strings (user ids, uris
+# from pyspotify), which the safe loaders refuse
+class legacy_loader(yaml_loader):
+    pass
+
+def construct_legacy_str(loader, node):
+    return loader.construct_scalar(node)
+
+legacy_loader.add_constructor(u"tag:yaml.org,2002:python/unicode", construct_legacy_str)
+legacy_loader.add_constructor(u"tag:yaml.org,2002:python/str", construct_legacy_str)
+
+def atomic_write(path, write):
+    tmp = path + ".tmp"
+
+    with open(tmp, 'w') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.rename(tmp, path)
+
+def atomic_dump(data, path):
+    atomic_write(path, lambda f: yaml.dump(data, f, Dumper=yaml_dumper))
+
+def safe_load(path):
+    with open(path) as f:
+        return yaml.load(f, Loader=legacy_loader)
+
+# snapshots hold dictified metadata for every track, so they are written
+# as json, which is much quicker to parse than yaml on a slow device
+def snapshot_dump(data, path):
+    atomic_write(path, lambda f: json.dump(data, f))
+
+def snapshot_load(path):
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError as e:
+        log.warning("ignoring broken snapshot {}: {}".format(path, e))
+        return None
+
+class user_journal(object):
+    def __init__(self, path, sync=.5, compact=1000):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.sync = sync
+        self.compact_size = compact
+        self.lock = lock()
+        self.dirty = event()
+        self.stopping = event()
+        self.tracks = []
+        self.seq = 0
+        # tracks archived from the head of the list so far
+        self.base = 0
+        self.entries = 0
+        self.journal = None
+        self.thread = None
+
+    def load(self):
+        snapshot_seq = 0
+        self.tracks = []
+        self.base = 0
+
+        if os.path.exists(self.path):
+            snapshot = safe_load(self.path)
+
+            # older versions wrote plain lists of users without uris
+            if isinstance(snapshot, dict):
+                snapshot_seq = snapshot.get("seq", 0)
+                self.base = snapshot.get("base", 0)
+                self.tracks = [list(track) for track in snapshot.get("tracks") or []]
+                self.tracks += [[None, user] for user in snapshot.get("users") or []]
+            elif snapshot:
+                self.tracks = [[None, user] for user in snapshot]
+
+        self.seq = snapshot_seq
+        self.entries = 0
+
+        torn = False
+
+        if os.path.exists(self.journal_path):
+            torn = not self.replay(snapshot_seq)
+
+        self.journal = open(self.journal_path, 'a')
+
+        if torn:
+            self.compact()
+
+        log.debug("loaded {} user tracks (seq {}, base {})".format(len(self.tracks), self.seq, self.base))
+
+        return self.tracks
+
+    def replay(self, snapshot_seq):
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    log.warning("ignoring torn journal entry: {!r}".format(line))
+                    return False
+
+                seq = entry[0]
+
+                if seq <= snapshot_seq:
+                    continue
+
+                self.apply(entry[1], *entry[2:])
+                self.seq = seq
+                self.entries += 1
+
+        return True
+
+    def apply(self, op, *args):
+        if op == "add":
+            self.tracks.append([args[1] if len(args) > 1 else None, args[0]])
+        elif op == "insert":
+            self.tracks.insert(args[0], [args[2] if len(args) > 2 else None, args[1]])
+        elif op == "remove":
+            del self.tracks[args[0]]
+        elif op == "archive":
+            del self.tracks[:args[0]]
+            self.base += args[0]
+        else:
+            log.warning("unknown journal op: {}".format(op))
+
+    def append(self, op, *args):
+        self.append_many([(op,) + args])
+
+    def append_many(self, entries):
+        lines = []
+
+        with self.lock:
+            for entry in entries:
+                self.apply(*entry)
+                self.seq += 1
+                self.entries += 1
+                lines.append(json.dumps([self.seq] + list(entry)) + "\n")
+
+            self.journal.write("".join(lines))
+            self.dirty.set()
+
+    def add(self, user_id, uri=None):
+        self.append("add", user_id, uri)
+
+    def insert(self, idx, user_id, uri=None):
+        self.append("insert", idx, user_id, uri)
+
+    def remove(self, idx):
+        self.append("remove", idx)
+
+    def archive(self, count):
+        # one entry moves the head and the base together, and it is on
+        # disk before the tracks leave the spotify playlist
+        self.append("archive", count)
+        self.flush()
+
+    def reset(self, tracks):
+        with self.lock:
+            self.tracks = [list(track) for track in tracks]
+            self.seq += 1
+            self.compact()
+
+    def compact(self):
+        with self.lock:
+            atomic_dump({"seq": self.seq, "base": self.base, "tracks": self.tracks}, self.path)
+            self.journal.close()
+            self.journal = open(self.journal_path, 'w')
+            self.entries = 0
+
+        log.debug("compacted user journal (seq {})".format(self.seq))
+
+    def flush(self):
+        with self.lock:
+            self.dirty.clear()
+
+            if not self.journal:
+                return
+
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+            if self.entries >= self.compact_size:
+                self.compact()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.dirty.wait()
+
+            # batch up entries arriving within the sync interval
+            self.stopping.wait(self.sync)
+            self.flush()
+
+    def start(self):
+        self.thread = thread(None, self.run, "user journal")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.dirty.set()
+
+        if self.thread:
+            self.thread.join()
+
+        self.flush()
+
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+# Played tracks archived out of the playlist, one json line each, oldest
+# first. Only line offsets are kept in memory, so pages are read straight
+# from the file however long the history grows.
+class history_store(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = lock()
+        self.offsets = array("l")
+        self.size = 0
+        self.last = -1
+
+    @property
+    def count(self):
+        return len(self.offsets)
+
+    def load(self):
+        self.offsets = array("l")
+        self.size = 0
+        self.last = -1
+
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    log.warning("ignoring torn history entry: {!r}".format(line))
+                    break
+
+                self.offsets.append(self.size)
+                self.size += len(line)
+                self.last = record["position"]
+
+        # drop a torn tail so appends start on a fresh line
+        if self.size != os.path.getsize(self.path):
+            with open(self.path, 'ab') as f:
+                f.truncate(self.size)
+
+        log.debug("loaded {} history entries".format(self.count))
+
+    def append_many(self, records):
+        with self.lock:
+            # positions already written by an archive that did not finish
+            records = [record for record in records if record["position"] > self.last]
+
+            if not records:
+                return
+
+            lines = [(json.dumps(record) + "\n").encode("utf-8") for record in records]
+
+            with open(self.path, 'ab') as f:
+                f.write(b"".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+            for line in lines:
+                self.offsets.append(self.size)
+                self.size += len(line)
+
+            self.last = records[-1]["position"]
+
+    def page(self, before=None, limit=50):
+        # newest first, ending just before the given index
+        if limit < 1:
+            return []
+
+        with self.lock:
+            end = self.count if before is None else max(min(before, self.count), 0)
+            start = max(end - limit, 0)
+
+            if start == end:
+                return []
+
+            first = self.offsets[start]
+            last = self.offsets[end] if end < self.count else self.size
+
+        with open(self.path, 'rb') as f:
+            f.seek(first)
+            data = f.read(last - first)
+
+        records = [json.loads(line.decode("utf-8")) for line in data.splitlines()]
+
+        for idx,record in enumerate(records):
+            record["index"] = start + idx
+
+        return list(reversed(records))
+
+class state_store(object):
+    def __init__(self, path, delay=1):
+        self.path = path
+        self.delay = delay
+        self.lock = lock()
+        self.dirty = event()
+        self.stopping = event()
+        self.changed = False
+        self.state = {}
+        self.thread = None
+
+    def load(self, defaults):
+        self.state = dict(defaults)
+
+        if os.path.exists(self.path):
+            self.state.update(safe_load(self.path) or {})
+
+        return self.state
+
+    def __contains__(self, key):
+        return key in self.state
+
+    def get(self, key):
+        with self.lock:
+            return self.state[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.state[key] = value
+            self.changed = True
+            self.dirty.set()
+
+    def flush(self):
+        with self.lock:
+            self.dirty.clear()
+
+            if not self.changed:
+                return
+
+            atomic_dump(dict(self.state), self.path)
+            self.changed = False
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.dirty.wait()
+
+            # coalesce bursts of updates into a single write
+            self.stopping.wait(self.delay)
+            self.flush()
+
+    def start(self):
+        self.thread = thread(None, self.run, "state store")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.dirty.set()
+
+        if self.thread:
+            self.thread.join()
+
+        self.flush()
@@ -0,0 +1,58 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from store import user_journal
+from store import safe_load
+
+# what yaml.dump([u'a']) writes under python 2
+py2_user_list = "- !!python/unicode 'a'\n"
+
+class legacy_yaml_test(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "user_list.yaml")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, data):
+        with open(self.path, 'w') as f:
+            f.write(data)
+
+    def test_py2_user_list(self):
+        self.write(py2_user_list)
+        journal = user_journal(self.path)
+
+        try:
+            self.assertEqual(journal.load(), [[None, "a"]])
+        finally:
+            journal.stop()
+
+    @unittest.skipUnless(sys.version_info[0] == 2, "needs python 2 unicode dumps")
+    def test_py2_dumped_user_list(self):
+        self.write(yaml.dump([u'a']))
+        journal = user_journal(self.path)
+
+        try:
+            self.assertEqual(journal.load(), [[None, u"a"]])
+        finally:
+            journal.stop()
+
+    def test_py2_config(self):
+        # config.yaml after the playlist uri from pyspotify was saved
+        self.write("spotify_playlist:\n"
+                   "  name: !!python/unicode 'sbox'\n"
+                   "  uri: !!python/unicode 'spotify:user:x:playlist:1'\n")
+
+        self.assertEqual(safe_load(self.path),
+                         {"spotify_playlist": {"name": "sbox", "uri": "spotify:user:x:playlist:1"}})
+
+if __name__ == "__main__":
+    unittest.main()